@@ -14,8 +14,18 @@
 #      You should have received a copy of the GNU General Public License
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from .database import build_db
+from .api import BuildOptions, build, iter_rules
+from .config import Configuration
+from .database import BuildError, BuildReport, build_db
+from .output import load_packed
 
 __all__ = [
+    'BuildError',
+    'BuildOptions',
+    'BuildReport',
+    'Configuration',
+    'build',
     'build_db',
+    'iter_rules',
+    'load_packed',
 ]
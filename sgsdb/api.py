@@ -0,0 +1,156 @@
+#      Semgrep-Search Database
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+import asyncio
+import dataclasses
+import multiprocessing
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, AsyncGenerator, Optional
+
+from sgsdb.config import Configuration
+from sgsdb.database import BuildReport, collect, run_build
+from sgsdb.duplicates import DuplicateIndex
+from sgsdb.output import FORMATS
+from sgsdb.parsing.parallel import CloseableQueue, Closed
+from sgsdb.rule import Rule
+
+# Number of files whose rules are held back while the consumer of iter_rules is busy
+RULE_QUEUE_SIZE = 64
+
+
+@dataclass
+class BuildOptions:
+    """
+    Options of a build, mirrors the command line options of sgs-db and uses the same defaults. With the process
+    executor, workers are started by a fork server that imports the main module, so scripts have to start the build
+    from within an if __name__ == '__main__' block.
+    """
+    database: str | Path
+    format: Optional[str] = None
+    append: bool = False
+    incremental: bool = False
+    verify: bool = False
+    verify_cache: bool = False
+    shard_by: str = 'repo'
+    compression: str = 'auto'
+    near_duplicates: bool = False
+    near_duplicate_threshold: float = 0.9
+    log_duplicates: bool = False
+    ignore_duplicates: bool = False
+    duplicate_key: str = 'id'
+    quiet: bool = False
+    cache: bool = False
+    parse_cache: bool = False
+    parse_cache_size: int = 256
+    progress: bool = False
+    threads: int = field(default_factory=multiprocessing.cpu_count)
+    pipeline_depth: int = 2
+    queue_size: int = 64
+    executor: str = 'thread'
+    yaml_engine: str = 'rt'
+    stats_json: Optional[str | Path] = None
+    verbose: int = 0
+
+    def __post_init__(self) -> None:
+        if self.format is not None and self.format not in FORMATS:
+            raise ValueError(f'Unknown format: {self.format}')
+        if self.format is not None and (self.append or self.incremental) and not FORMATS[self.format].updatable:
+            raise ValueError(f'append and incremental are not supported by the {self.format} format')
+        if not 0 < self.near_duplicate_threshold <= 1:
+            raise ValueError('near_duplicate_threshold has to be between 0 and 1')
+        if self.threads < 1:
+            raise ValueError('threads has to be at least 1')
+        if self.stats_json is not None:
+            self.stats_json = Path(self.stats_json)
+
+    def to_namespace(self) -> argparse.Namespace:
+        """
+        Converts the options into the namespace the build expects, as if they had been passed on the command line
+        """
+        options = dataclasses.asdict(self)
+        return argparse.Namespace(DATABASE=str(options.pop('database')), profile=None, **options)
+
+
+def _configuration(config: Configuration | dict[str, Any]) -> Configuration:
+    return config if isinstance(config, Configuration) else Configuration.from_dict(config)
+
+
+async def build(config: Configuration | dict[str, Any], options: BuildOptions) -> BuildReport:
+    """
+    Builds the database without blocking the event loop. Downloads and parsing run concurrently in the threads or
+    processes of the pipeline, which is driven from a thread of the default executor. Raises a BuildError if a
+    repository could not be processed.
+    """
+    return await asyncio.to_thread(run_build, options.to_namespace(), _configuration(config))
+
+
+async def iter_rules(config: Configuration | dict[str, Any], options: BuildOptions) -> AsyncGenerator[Rule, None]:
+    """
+    Yields the rules of all repositories in the order they would be added to the database, without writing one.
+    Duplicates are dropped if options.ignore_duplicates is set. Closing the iterator early stops the build: the
+    repositories that are being parsed stop after the files at hand and the remaining ones are not fetched.
+    """
+    args = options.to_namespace()
+    configuration = _configuration(config)
+    queue = CloseableQueue[list[Rule]](RULE_QUEUE_SIZE)
+    errors = []
+
+    def produce() -> None:
+        ids = DuplicateIndex(args.duplicate_key)
+        results = collect(args, configuration)
+        try:
+            for result in results:
+                rules = []
+                for rule in result.rules:
+                    if args.ignore_duplicates and (rule.source, rule.id) in ids:
+                        continue
+                    ids.add(rule.source, rule.id)
+                    rules.append(rule)
+                if rules:
+                    queue.put(rules)
+        except Closed:
+            pass
+        except Exception as e:
+            errors.append(e)
+        finally:
+            results.close()
+            queue.close()
+
+    def take() -> Optional[list[Rule]]:
+        try:
+            return queue.get()
+        except Closed:
+            return None
+
+    producer = threading.Thread(name='iter-rules', target=produce)
+    producer.daemon = True
+    producer.start()
+    try:
+        while (rules := await asyncio.to_thread(take)) is not None:
+            for rule in rules:
+                yield rule
+    finally:
+        queue.close()
+        # Unblocks the producer if it is waiting for room in the queue
+        while take() is not None:
+            pass
+        await asyncio.to_thread(producer.join)
+
+    if errors:
+        raise errors[0]
+
@@ -0,0 +1,99 @@
+#      Semgrep-Search Database
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import mmap
+import struct
+import threading
+import zlib
+from functools import partial
+from pathlib import Path
+from typing import NamedTuple
+from zipfile import ZipFile, BadZipFile, ZIP_STORED, ZIP_DEFLATED
+
+from sgsdb.parsing.model import ContentLoader
+
+LOCAL_HEADER = struct.Struct('<4s22xHH')
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+
+# Archives mapped by the current process, used when archives are passed to worker processes
+_mapped: dict[tuple[str, int], 'MappedArchive'] = {}
+_mapped_lock = threading.Lock()
+
+
+class Member(NamedTuple):
+    name: str
+    # Offset of the local file header within the archive
+    offset: int
+    compress_type: int
+    compress_size: int
+    file_size: int
+    crc: int
+
+
+def _open_mapped(path: str, mtime: int) -> 'MappedArchive':
+    with _mapped_lock:
+        archive = _mapped.get((path, mtime))
+        if archive is None:
+            archive = _mapped[(path, mtime)] = MappedArchive(Path(path))
+        return archive
+
+
+class MappedArchive:
+    """
+    Memory-mapped zip archive. Members are decompressed straight from the mapping by their offset, so any number of
+    threads can read members concurrently without sharing a file handle. When passed to a worker process, the archive
+    is mapped again by the worker.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        with path.open('rb') as fin:
+            self.mtime = path.stat().st_mtime_ns
+            with ZipFile(fin) as archive:
+                self.members = [
+                    Member(info.filename, info.header_offset, info.compress_type, info.compress_size, info.file_size,
+                           info.CRC)
+                    for info in archive.infolist() if not info.is_dir()
+                ]
+            self._map = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __reduce__(self) -> tuple:
+        return _open_mapped, (str(self.path), self.mtime)
+
+    def read(self, member: Member) -> bytes:
+        signature, name_length, extra_length = LOCAL_HEADER.unpack_from(self._map, member.offset)
+        if signature != LOCAL_HEADER_SIGNATURE:
+            raise BadZipFile(f'Bad magic number for file header of {member.name}')
+
+        start = member.offset + LOCAL_HEADER.size + name_length + extra_length
+        data = self._map[start:start + member.compress_size]
+        if member.compress_type == ZIP_STORED:
+            content = data
+        elif member.compress_type == ZIP_DEFLATED:
+            content = zlib.decompress(data, -zlib.MAX_WBITS, member.file_size or zlib.DEF_BUF_SIZE)
+        else:
+            # Other compression methods are rare enough to not warrant a dedicated implementation
+            with ZipFile(self.path) as archive:
+                return archive.read(member.name)
+
+        if zlib.crc32(content) != member.crc:
+            raise BadZipFile(f'Bad CRC-32 for file {member.name}')
+        return content
+
+    def loader(self, member: Member) -> ContentLoader:
+        return partial(self.read, member)
+
+    def close(self) -> None:
+        self._map.close()
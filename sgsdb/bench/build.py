@@ -0,0 +1,185 @@
+#      Semgrep-Search Database
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+Benchmarks complete database builds over synthetic rule repositories. The repositories are generated as zip archives
+and every configuration is built in a fresh sgs-db process, so timings and peak memory are not influenced by previous
+runs.
+
+    python -m sgsdb.bench.build --repos 4 --files 200 --threads 1,2,4 --executor thread,process -o bench.json
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+from typing import Any
+
+from ruamel.yaml import YAML
+
+import sgsdb
+from sgsdb.bench.synthetic import generate_file
+from sgsdb.util import get_version
+
+RE_RESULT = re.compile(r'resulting in (\d+) rules')
+
+
+def generate(args: argparse.Namespace, workdir: Path) -> dict[str, Any]:
+    """
+    Writes the synthetic archives and a configuration using them to the working directory
+    """
+    rng = random.Random(args.seed)  # noqa: S311
+    repositories = {}
+    for repo in range(args.repos):
+        name = f'bench{repo}'
+        path = workdir / f'{name}.zip'
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr(f'{name}-main/README.md', f'# {name}\n')
+            for file in range(args.files):
+                content = generate_file(rng, f'{name}-{file}', args.rules, args.depth, args.invalid_ratio)
+                archive.writestr(f'{name}-main/rules/{file // 100}/rule{file}.yaml', content)
+                # Every archive ships test files next to the rules, just like the real repositories
+                if file % 10 == 0:
+                    archive.writestr(f'{name}-main/rules/{file // 100}/rule{file}.test.yaml', content)
+        repositories[name] = {'name': f'Benchmark {repo}', 'type': 'archive', 'path': str(path), 'license': 'MIT'}
+
+    with (workdir / 'config.yaml').open('w') as fout:
+        YAML(typ='safe', pure=True).dump({'repositories': repositories}, fout)
+    return repositories
+
+
+def run_build(workdir: Path, options: list[str]) -> dict[str, Any]:
+    """
+    Builds the database in a separate process and measures its wall time and peak memory
+    """
+    database = workdir / 'bench.db'
+    stats = workdir / 'stats.json'
+    for path in (database, Path(f'{database}.manifest.json'), stats):
+        path.unlink(missing_ok=True)
+
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join(filter(None, [
+        str(Path(sgsdb.__file__).parent.parent), os.environ.get('PYTHONPATH')]))}
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, '-m', 'sgsdb.main', '-q', '--stats-json', str(stats), *options,  # noqa: S603
+                             str(database)],
+                            cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = proc.stderr.read().decode('utf8', errors='replace')
+    # wait4 reports the resource usage of this build alone, including the worker processes it spawned
+    _, status, usage = os.wait4(proc.pid, 0)
+    elapsed = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    proc.stderr.close()
+
+    result = {
+        'returncode': proc.returncode,
+        'seconds': round(elapsed, 3),
+        # ru_maxrss is reported in KiB on Linux
+        'peak_rss_mib': round(usage.ru_maxrss / 1024, 1),
+        'stages': {'build': round(elapsed, 3)},
+    }
+    if stats.exists():
+        with stats.open('r') as fin:
+            report = json.load(fin)
+        # Stages run concurrently in several workers, so their times add up to more than the build took
+        result['stages'].update({stage: timing['seconds'] for stage, timing in report['stages'].items()})
+        result['repositories'] = {repo: repository['counts'] for repo, repository in report['repositories'].items()}
+
+    match = RE_RESULT.search(stderr)
+    if proc.returncode != 0 or match is None:
+        result['error'] = stderr.strip().splitlines()[-1] if stderr.strip() else 'Unknown error'
+        return result
+    result['rules'] = int(match.group(1))
+    return result
+
+
+def split(value: str) -> list[str]:
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='python -m sgsdb.bench.build',
+                                     description='Benchmark database builds over synthetic repositories')
+    parser.add_argument('--repos', type=int, default=2, help='Number of repositories')
+    parser.add_argument('--files', type=int, default=100, help='Number of rule files per repository')
+    parser.add_argument('--rules', type=int, default=5, help='Number of rules per file')
+    parser.add_argument('--depth', type=int, default=1, help='Nesting depth of the rule patterns')
+    parser.add_argument('--invalid-ratio', type=float, default=0.05, help='Ratio of rules missing required fields')
+    parser.add_argument('--threads', type=split, default=['1'], help='Comma separated thread counts to benchmark')
+    parser.add_argument('--executor', type=split, default=['thread'], help='Comma separated executors to benchmark')
+    parser.add_argument('--yaml-engine', type=split, default=['rt'], help='Comma separated YAML engines to benchmark')
+    parser.add_argument('--format', type=split, default=['json'], help='Comma separated output formats to benchmark')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of builds per configuration')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for generating the repositories')
+    parser.add_argument('--workdir', type=Path, default=None,
+                        help='Directory for the generated repositories (Defaults to a temporary directory)')
+    parser.add_argument('-o', '--output', type=Path, default=None, help='Write the report to a file instead of stdout')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='sgsdb-bench-') as tmp:
+        workdir = args.workdir or Path(tmp)
+        workdir.mkdir(parents=True, exist_ok=True)
+
+        start = time.perf_counter()
+        generate(args, workdir)
+        generation = time.perf_counter() - start
+
+        files = args.repos * args.files
+        runs = []
+        for threads, executor, engine, output_format in itertools.product(args.threads, args.executor,
+                                                                          args.yaml_engine, args.format):
+            options = ['-t', threads, '-e', executor, '-y', engine, '-f', output_format]
+            for iteration in range(args.repeat):
+                result = run_build(workdir, options)
+                if 'rules' in result:
+                    result['files_per_second'] = round(files / result['seconds'], 1)
+                    result['rules_per_second'] = round(result['rules'] / result['seconds'], 1)
+                runs.append({'threads': int(threads), 'executor': executor, 'yaml_engine': engine,
+                             'format': output_format, 'iteration': iteration, **result})
+                sys.stderr.write(f'threads={threads} executor={executor} yaml_engine={engine} '
+                                 f'format={output_format}: {result["seconds"]}s\n')
+
+    report = {
+        'version': get_version(),
+        'python': sys.version.split()[0],
+        'cpus': os.cpu_count(),
+        'workload': {
+            'repos': args.repos,
+            'files': args.files,
+            'rules': args.rules,
+            'depth': args.depth,
+            'invalid_ratio': args.invalid_ratio,
+            'seed': args.seed,
+        },
+        'generate_seconds': round(generation, 3),
+        'runs': runs,
+    }
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with args.output.open('w') as fout:
+            json.dump(report, fout, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,142 @@
+#      Semgrep-Search Database
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+Measures remove_comments on rule trees as loaded by the round-trip loader, comparing the former recursive
+implementation (before) with the iterative one (after). Rules are taken from a repository archive, e.g. one of the
+archives in cache/, or generated.
+
+    python -m sgsdb.bench.comments --archive cache/semgrep.zip
+"""
+import argparse
+import json
+import random
+import sys
+import time
+import tracemalloc
+import zipfile
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from ruamel.yaml import YAML, CommentedMap, CommentedSeq
+
+from sgsdb.bench.synthetic import generate_file
+from sgsdb.parsing.matching import RE_RULE_PATH
+from sgsdb.util import remove_comments
+
+
+def remove_comments_recursive(data: Any) -> Any:  # noqa: ANN401
+    if isinstance(data, (dict, OrderedDict, CommentedMap)):
+        return CommentedMap(OrderedDict([
+            (key, remove_comments_recursive(value)) for key, value in data.items()
+        ]))
+
+    if isinstance(data, (list, CommentedSeq)):
+        return CommentedSeq([remove_comments_recursive(item) for item in data])
+
+    return data
+
+
+def load_rules(archive: Optional[Path], count: int, depth: int, seed: int) -> list[Any]:
+    yaml = YAML(typ='rt')
+    if archive is None:
+        return list(yaml.load(generate_file(random.Random(seed), 'bench', count, depth))['rules'])  # noqa: S311
+
+    rules = []
+    with zipfile.ZipFile(archive) as fin:
+        for name in fin.namelist():
+            if not RE_RULE_PATH.match(name):
+                continue
+            try:
+                data = yaml.load(fin.read(name))
+                rules.extend(data['rules'])
+            except Exception:  # noqa: S112
+                continue
+    return rules
+
+
+def measure(rules: list[Any], strip: Callable[[Any], Any], repeat: int) -> tuple[float, int]:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for rule in rules:
+            strip(rule)
+        best = min(best, time.perf_counter() - start)
+
+    # Peak memory allocated while copying a rule, including intermediate objects. Measured in a separate run as
+    # tracing slows everything down.
+    peak = 0
+    tracemalloc.start()
+    for rule in rules:
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        copy = strip(rule)
+        _, after = tracemalloc.get_traced_memory()
+        peak += after - before
+        del copy
+    tracemalloc.stop()
+    return best / len(rules), peak // len(rules)
+
+
+def max_depth(strip: Callable[[Any], Any], limit: int) -> int:
+    """
+    Returns the deepest nesting of patterns (up to limit) that can be processed
+    """
+    for depth in (10, 100, 1000, limit):
+        data = CommentedMap({'pattern': 'foo()'})
+        for _ in range(depth):
+            data = CommentedMap({'patterns': CommentedSeq([data])})
+        try:
+            strip(data)
+        except RecursionError:
+            return depth // 10
+    return limit
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='python -m sgsdb.bench.comments',
+                                     description='Benchmark removing comments from rules')
+    parser.add_argument('--archive', type=Path, default=None,
+                        help='Take the rules from a repository archive instead of generating them')
+    parser.add_argument('--rules', type=int, default=500, help='Number of rules to generate')
+    parser.add_argument('--depth', type=int, default=2, help='Nesting depth of the generated rule patterns')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of repetitions, the best one is reported')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for generating the rules')
+    args = parser.parse_args()
+
+    rules = load_rules(args.archive, args.rules, args.depth, args.seed)
+    if not rules:
+        parser.error('No rules found')
+
+    before, before_size = measure(rules, remove_comments_recursive, args.repeat)
+    after, after_size = measure(rules, remove_comments, args.repeat)
+
+    json.dump({
+        'rules': len(rules),
+        'before_us_per_rule': round(before * 1e6, 1),
+        'after_us_per_rule': round(after * 1e6, 1),
+        'speedup': round(before / after, 2),
+        'before_peak_bytes_per_rule': before_size,
+        'after_peak_bytes_per_rule': after_size,
+        'before_max_depth': max_depth(remove_comments_recursive, 10000),
+        'after_max_depth': max_depth(remove_comments, 10000),
+    }, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
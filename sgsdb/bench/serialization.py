@@ -0,0 +1,92 @@
+#      Semgrep-Search Database
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+Measures the per rule cost of serializing rules (content and full_content), comparing fresh YAML instances and
+re-dumping (before) with pooled instances and a full_content derived from the content (after).
+
+    python -m sgsdb.bench.serialization --rules 500
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from io import StringIO
+from typing import Callable
+
+from ruamel.yaml import YAML, CommentedMap, CommentedSeq
+
+from sgsdb.bench.synthetic import generate_file
+from sgsdb.repository import GithubOrigin
+from sgsdb.rule import Rule
+from sgsdb.util import remove_comments, get_yaml
+
+REPO = GithubOrigin(id='bench', name='Benchmark', license='MIT', repo='bench/rules', branch='main')
+
+
+def serialize_before(data: dict) -> tuple[str, str]:
+    buf = StringIO()
+    YAML(typ='rt').dump(data, buf)
+    full = StringIO()
+    YAML(typ='rt').dump(CommentedMap({'rules': CommentedSeq([data])}), full)
+    return buf.getvalue(), full.getvalue()
+
+
+def serialize_after(data: dict) -> tuple[str, str]:
+    buf = StringIO()
+    get_yaml().dump(data, buf)
+    rule = Rule('bench', data['id'], None, [], None, None, data, buf.getvalue())
+    return rule.content, rule.full_content
+
+
+def measure(rules: list[dict], serialize: Callable[[dict], tuple[str, str]], repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for data in rules:
+            serialize(data)
+        best = min(best, time.perf_counter() - start)
+    return best / len(rules)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='python -m sgsdb.bench.serialization',
+                                     description='Benchmark the serialization of rules')
+    parser.add_argument('--rules', type=int, default=500, help='Number of rules to serialize')
+    parser.add_argument('--depth', type=int, default=2, help='Nesting depth of the rule patterns')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of repetitions, the best one is reported')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for generating the rules')
+    args = parser.parse_args()
+
+    content = generate_file(random.Random(args.seed), 'bench', args.rules, args.depth)  # noqa: S311
+    rules = [Rule.from_file(REPO, remove_comments(rule), 'rules-main/bench.yaml').data
+             for rule in YAML(typ='rt').load(content)['rules']]
+
+    before = measure(rules, serialize_before, args.repeat)
+    after = measure(rules, serialize_after, args.repeat)
+
+    json.dump({
+        'rules': args.rules,
+        'before_us_per_rule': round(before * 1e6, 1),
+        'after_us_per_rule': round(after * 1e6, 1),
+        'speedup': round(before / after, 2),
+    }, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,67 @@
+#      Semgrep-Search Database
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import random
+
+SEVERITIES = ['INFO', 'WARNING', 'ERROR']
+LANGUAGES = ['python', 'js', 'java', 'go', 'ruby', 'php']
+
+
+def generate_patterns(rng: random.Random, depth: int) -> str:
+    """
+    Generates a nested patterns block, depth controls how deeply pattern-either and patterns are nested
+    """
+    lines = []
+
+    def emit(level: int, indent: str) -> None:
+        lines.append(f'{indent}- pattern: foo{rng.randint(0, 1 << 16)}($X, ...)')
+        lines.append(f'{indent}- pattern-not: |')
+        lines.append(f'{indent}    bar($X)')
+        lines.append(f'{indent}    baz{rng.randint(0, 1 << 16)}()')
+        if level < depth:
+            lines.append(f'{indent}- pattern-either:  # nested alternatives')
+            lines.append(f'{indent}  - patterns:')
+            emit(level + 1, f'{indent}    ')
+            lines.append(f'{indent}  - pattern: $Y.call{rng.randint(0, 1 << 16)}()')
+
+    emit(0, '    ')
+    return '\n'.join(lines)
+
+
+def generate_rule(rng: random.Random, rule_id: str, depth: int = 1, *, invalid: bool = False) -> str:
+    languages = ', '.join(rng.sample(LANGUAGES, rng.randint(1, 2)))
+    rule = [
+        f'  # {rule_id}',
+        f'  - id: {rule_id}',
+        '    message: >-',
+        f'      Synthetic finding {rng.randint(0, 1 << 32)} for benchmarking, review the flagged call.',
+        f'    languages: [{languages}]',
+        '    metadata:',
+        '      category: security  # synthetic',
+        f'      cwe: "CWE-{rng.randint(1, 1000)}"',
+        '      references:',
+        '        - https://example.com/rule',
+    ]
+    # Invalid rules miss the severity required by the validation
+    if not invalid:
+        rule.append(f'    severity: {rng.choice(SEVERITIES)}')
+    rule.append('    patterns:')
+    rule.append(generate_patterns(rng, depth))
+    return '\n'.join(rule) + '\n'
+
+
+def generate_file(rng: random.Random, prefix: str, rules: int, depth: int = 1, invalid_ratio: float = 0.0) -> str:
+    return 'rules:\n' + ''.join(generate_rule(rng, f'{prefix}-{index}', depth, invalid=rng.random() < invalid_ratio)
+                                for index in range(rules))
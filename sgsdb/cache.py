@@ -0,0 +1,133 @@
+#      Semgrep-Search Database
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from sgsdb.util import logger
+
+PARSE_CACHE_PATH = Path('cache/parse-cache.sqlite')
+VERIFY_CACHE_PATH = Path('cache/verify-cache.sqlite')
+VERIFY_CACHE_SIZE = 64 * 1024 * 1024
+
+
+class SQLiteCache:
+    """
+    Persistent key value store with least recently used eviction, safe to be shared between threads and processes
+    """
+
+    def __init__(self, path: Path) -> None:
+        path.parent.mkdir(exist_ok=True, parents=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS entries '
+                          '(key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            row = self.conn.execute('SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute('UPDATE entries SET accessed = ? WHERE key = ?', (time.time(), key))
+            return row[0]
+
+    def put(self, key: str, value: str) -> None:
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO entries (key, value, size, accessed) VALUES (?, ?, ?, ?)',
+                              (key, value, len(value), time.time()))
+
+    def evict(self, max_size: int) -> int:
+        """
+        Removes the least recently used entries until the cache holds at most max_size bytes of values
+        """
+        with self.lock:
+            total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+            if total <= max_size:
+                return 0
+
+            removed = 0
+            rows = self.conn.execute('SELECT key, size FROM entries ORDER BY accessed').fetchall()
+            self.conn.execute('BEGIN')
+            for key, size in rows:
+                if total <= max_size:
+                    break
+                self.conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+                total -= size
+                removed += 1
+            self.conn.execute('COMMIT')
+            return removed
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
+
+
+class ParseCache(SQLiteCache):
+    """
+    Stores the outcome of parsing a file, keyed on everything the parsed rules depend on
+    """
+
+    def __init__(self, path: Path = PARSE_CACHE_PATH) -> None:
+        super().__init__(path)
+
+    def get_result(self, key: str) -> Optional[tuple[list[int], list[dict]]]:
+        value = self.get(key)
+        if value is None:
+            return None
+        try:
+            data = json.loads(value)
+            return data['status'], data['rules']
+        except (ValueError, KeyError) as e:
+            logger.debug('Ignoring broken parse cache entry %s: %s', key, str(e))
+            return None
+
+    def put_result(self, key: str, status: list[int], rules: list[dict]) -> None:
+        self.put(key, json.dumps({'status': status, 'rules': rules}))
+
+
+class VerificationCache(SQLiteCache):
+    """
+    Stores the outcome of semgrep --validate for a rule, keyed on the rule content and the semgrep version
+    """
+
+    def __init__(self, path: Path = VERIFY_CACHE_PATH) -> None:
+        super().__init__(path)
+
+    @staticmethod
+    def key(content: str, version: str) -> str:
+        return hashlib.sha256(f'{version}\0{content}'.encode('utf8')).hexdigest()
+
+    def get_verdict(self, key: str) -> Optional[tuple[bool, str]]:
+        value = self.get(key)
+        if value is None:
+            return None
+        try:
+            data = json.loads(value)
+            return data['valid'], data['stderr']
+        except (ValueError, KeyError) as e:
+            logger.debug('Ignoring broken verification cache entry %s: %s', key, str(e))
+            return None
+
+    def put_verdict(self, key: str, valid: bool, stderr: str) -> None:  # noqa: FBT001
+        self.put(key, json.dumps({'valid': valid, 'stderr': stderr}))
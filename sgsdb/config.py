@@ -14,7 +14,7 @@
 #      You should have received a copy of the GNU General Public License
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from pathlib import Path
-from typing import Generator, Any
+from typing import Any, Optional
 
 from ruamel.yaml import YAML
 
@@ -22,12 +22,29 @@ from sgsdb.repository import Repository
 
 
 class Configuration:
-    def __init__(self, file: Path) -> None:
-        yaml = YAML(typ='rt')
-        with file.open('r') as fin:
-            self.config: dict[str, Any] = yaml.load(fin)
+    def __init__(self, file: Optional[Path] = None, *, config: Optional[dict[str, Any]] = None) -> None:
+        if config is None:
+            yaml = YAML(typ='rt')
+            with file.open('r') as fin:
+                config = yaml.load(fin)
+        self.config: dict[str, Any] = config
+
+        # Repositories with a higher priority are processed first, so their rules win over duplicates of other ones
+        repositories = sorted(self.config['repositories'].items(), key=lambda item: -item[1].get('priority', 0))
+
+        # Repositories keep state between build stages (e.g. whether they have been fetched already), every build resets
+        # it before fetching them
+        self._repositories = [Repository.from_config(key, **{name: value for name, value in options.items()
+                                                             if name != 'priority'})
+                              for key, options in repositories]
+
+    @staticmethod
+    def from_dict(config: dict[str, Any]) -> 'Configuration':
+        """
+        Creates a configuration from data in the layout of config.yaml
+        """
+        return Configuration(config=config)
 
     @property
-    def repositories(self) -> Generator[Repository, None, None]:
-        for key, value in self.config['repositories'].items():
-            yield Repository.from_config(key, **value)
+    def repositories(self) -> list[Repository]:
+        return self._repositories
@@ -15,71 +15,311 @@
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import argparse
-import sys
-from datetime import datetime, timezone
-from typing import Generator
-
-from tinydb import TinyDB, Query
-from tinydb.storages import JSONStorage
-from tinydb.middlewares import CachingMiddleware
+from dataclasses import dataclass
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+from typing import Generator, Optional, NoReturn
 
+from sgsdb.cache import ParseCache, VerificationCache, SQLiteCache, VERIFY_CACHE_SIZE
 from sgsdb.config import Configuration
-from sgsdb.rule import Rule
+from sgsdb.duplicates import DuplicateIndex
+from sgsdb.manifest import Manifest
+from sgsdb.output import open_writer, resolve_format
+from sgsdb.parsing.model import ParsingResult
+from sgsdb.parsing.statistic import ResultStatus
+from sgsdb.pipeline import Pipeline
+from sgsdb.profiling import checkpoint
+from sgsdb.similarity import NearDuplicateIndex, signature, encode
+from sgsdb.timing import StageTimer, measure, collect as collect_timings
 from sgsdb.util import logger, human_readable, generate_metdata
 
+# Number of rules handed to the database writer at once
+INSERT_BATCH_SIZE = 1000
 
-def collect(args: argparse.Namespace, config: Configuration) -> Generator[Rule, None, None]:
-    for repo in config.repositories:
-        try:
-            yield from repo.iter_rules(args)
-        except Exception as e:
-            if not args.quiet:
-                logger.info(str(e), exc_info=e)
-                logger.debug(str(e))
-            logger.error(f'Exception during repository parsing: {str(e)}')
-            sys.exit(1)
 
+class BuildError(Exception):
+    """
+    Raised if a repository could not be processed. Formats that replace the database discard what was written so far,
+    the tinydb format keeps what it flushed before the failure. The manifest is invalidated in either case, so the next
+    build starts from scratch even with --incremental
+    """
+
+
+@dataclass
+class BuildReport:
+    database: str
+    format: str
+    rules: int
+    repositories: int
+    elapsed: timedelta
+    # Number of near-duplicate clusters, if they were detected
+    clusters: Optional[int] = None
 
-def build_db(args: argparse.Namespace, config: Configuration) -> int:
-    db = TinyDB(args.DATABASE, storage=CachingMiddleware(JSONStorage))
 
+def _abort(args: argparse.Namespace, e: Exception) -> NoReturn:
+    if not args.quiet:
+        logger.info(str(e), exc_info=e)
+        logger.debug(str(e))
+    logger.error(f'Exception during repository parsing: {str(e)}')
+    raise BuildError(str(e)) from e
+
+
+def collect(args: argparse.Namespace, config: Configuration,
+            manifest: Optional[Manifest] = None) -> Generator[ParsingResult, None, None]:
     try:
-        meta = db.table('meta')
-        meta.truncate()
-        metadata = generate_metdata()
+        yield from Pipeline(args, config.repositories, manifest)
+    except Exception as e:
+        _abort(args, e)
+
+
+def evict(cache: SQLiteCache, max_size: int, args: argparse.Namespace) -> None:
+    try:
+        removed = cache.evict(max_size)
+        if removed and args.verbose > 0:
+            logger.debug('Evicted %d entries from %s', removed, cache.path)
+    finally:
+        cache.close()
+
+
+def manifest_path(args: argparse.Namespace) -> Path:
+    return Path(f'{args.DATABASE}.manifest.json')
+
+
+def restore(args: argparse.Namespace, config: Configuration, manifest: Manifest,
+            reinsert: dict[tuple[str, str], set[str]], pending: list[dict],
+            near_duplicates: Optional[NearDuplicateIndex]) -> None:
+    """
+    Parses the files again whose rules were removed along with the rules of other files, or were not inserted because
+    a rule with the same ID preceded them, and queues the rules for insertion
+    """
+    repositories = {repo.id: repo for repo in config.repositories}
+    for source in dict.fromkeys(source for source, _ in reinsert):
+        paths = {path: rule_ids for (repo_id, path), rule_ids in reinsert.items() if repo_id == source and rule_ids}
+        if args.verbose > 1:
+            logger.debug('Parsing %d files of %s again to restore their rules', len(paths), source)
+        for result in repositories[source].reparse(args, set(paths)):
+            rule_ids = paths[result.path]
+            inserted = manifest.rules(source, result.path)
+            signatures = manifest.signatures(source, result.path)
+            for rule in result.rules:
+                if rule.id not in rule_ids:
+                    continue
+                if args.ignore_duplicates:
+                    rule_ids.discard(rule.id)
+                pending.append(rule.asdict())
+                # Rules that were skipped during the previous build have no signature yet
+                position = inserted.index(rule.id)
+                if near_duplicates is not None and signatures[position] is None:
+                    with measure('signature', source):
+                        value = signature(rule)
+                    if value is not None:
+                        near_duplicates.add(source, repositories[source].filepath(result.path), rule.id, value)
+                        signatures[position] = encode(value)
+
+
+def build_db(args: argparse.Namespace, config: Configuration) -> int:
+    run_build(args, config)
+    return 0
+
+
+def run_build(args: argparse.Namespace, config: Configuration) -> BuildReport:
+    # Every build collects its timings separately, even if several of them run in the same process
+    with collect_timings(enabled=bool(args.stats_json)) as timer:
+        return _run_build(args, config, timer)
+
+
+def _run_build(args: argparse.Namespace, config: Configuration, timer: Optional[StageTimer]) -> BuildReport:
+    metadata = generate_metdata()
+
+    manifest = Manifest.load(manifest_path(args), {'version': metadata['version'], 'verify': args.verify,
+                                                   'yaml_engine': args.yaml_engine,
+                                                   'near_duplicates': args.near_duplicates,
+                                                   'ignore_duplicates': args.ignore_duplicates,
+                                                   'duplicate_key': args.duplicate_key})
+    incremental = args.incremental and bool(manifest) and Path(args.DATABASE).exists()
+    if args.incremental and not incremental:
+        logger.info('No usable manifest found, building the whole database')
+    if not incremental:
+        manifest.clear()
+    # Only a build that ran to completion leaves a manifest behind
+    manifest.invalidate()
+
+    writer = open_writer(args)
+    if (args.append or incremental) and not writer.updatable:
+        writer.abort()
+        raise ValueError(f'The {resolve_format(args)} format does not support updating an existing database')
+
+    with writer:
         if args.verbose > 1:
             logger.debug('Using metadata: %s', ', '.join(f'{k}: {v}' for k, v in metadata.items()))
-        meta.insert(metadata)
+        writer.write_meta(metadata)
+        writer.write_repos([repo.to_dict() for repo in config.repositories])
 
-        repos = db.table('repos')
-        repos.truncate()
-        for repo in config.repositories:
-            repos.upsert(repo.to_dict(), Query().id == repo.id)
+        if not args.append and not incremental:
+            writer.clear_rules()
+
+        ids = DuplicateIndex(args.duplicate_key)
+        if args.append and not incremental:
+            # Rules already in the database count as duplicates as well
+            ids.update_all(writer.rule_ids())
+        seen = set()
+        near_duplicates = NearDuplicateIndex(args.near_duplicate_threshold) if args.near_duplicates else None
+        pending = []
+        # Files whose rules are in the database, keyed on the repository and the ID of the rules. Rules are removed by
+        # their repository and ID, which takes the rules of other files with the same ID along.
+        holders = manifest.holders() if incremental else {}
+        # Rules that have to be inserted again, keyed on the repository and the file they stem from
+        reinsert: dict[tuple[str, str], set[str]] = {}
 
-        if isinstance(db.storage, CachingMiddleware):
-            db.storage.flush()
+        def flush() -> None:
+            if pending:
+                with measure('db_insert'):
+                    writer.insert_rules(pending)
+                pending.clear()
 
-        rules = db.table('rules')
-        if not args.append:
-            rules.truncate()
+        def remove(source: str, path: str, rule_ids: list[str]) -> None:
+            flush()
+            with measure('db_remove'):
+                writer.remove_rules(source, rule_ids)
+            for rule_id in rule_ids:
+                others = holders.get((source, rule_id), set())
+                others.discard(path)
+                for other in others:
+                    reinsert.setdefault((source, other), set()).add(rule_id)
+                reinsert.get((source, path), set()).discard(rule_id)
 
-        ids = set()
+        def reclaim(source: str, path: str, digest: str) -> tuple[list[str], list[Optional[str]]]:
+            """
+            Decides again which rules of an unchanged file are duplicates, as the preceding files may have changed since
+            the previous build. Returns the rules that stay in the database along with their signatures.
+            """
+            previous = manifest.rules(source, path)
+            signatures = manifest.signatures(source, path) or [None] * len(previous)
+            inserted, kept, skipped, evicted = [], [], [], []
+            for rule_id, value in zip(previous, signatures, strict=True):
+                if (source, rule_id) in ids:
+                    evicted.append(rule_id)
+                else:
+                    ids.add(source, rule_id)
+                    inserted.append(rule_id)
+                    kept.append(value)
+            # The rules that shadowed these are gone, they are inserted once the file has been parsed again
+            for rule_id in manifest.skipped(source, path):
+                if (source, rule_id) in ids:
+                    skipped.append(rule_id)
+                else:
+                    ids.add(source, rule_id)
+                    inserted.append(rule_id)
+                    kept.append(None)
+                    holders.setdefault((source, rule_id), set()).add(path)
+                    reinsert.setdefault((source, path), set()).add(rule_id)
+
+            if evicted:
+                remove(source, path, evicted)
+            if evicted or len(skipped) != len(manifest.skipped(source, path)):
+                manifest.record(source, path, digest, inserted, kept if near_duplicates is not None else None,
+                                skipped)
+            return inserted, kept
 
         start_time = datetime.now(timezone.utc)
+        checkpoint('setup')
 
-        for rule in collect(args, config):
-            if rule.id in ids:
-                if args.log_duplicates:
-                    logger.warning('Found duplicate ID: %s in %s', rule.id, rule.source)
+        for result in collect(args, config, manifest if incremental else None):
+            source = result.repository.id
+            if result.digest is not None:
+                seen.add((source, result.path))
+
+            if ResultStatus.UNCHANGED in result.status:
                 if args.ignore_duplicates:
-                    continue
-            ids.add(rule.id)
-            rules.insert(rule.asdict())
+                    inserted, signatures = reclaim(source, result.path, result.digest)
+                else:
+                    inserted, signatures = manifest.rules(source, result.path), manifest.signatures(source, result.path)
+                    ids.update(source, inserted)
+                if near_duplicates is not None:
+                    near_duplicates.add_all(source, result.repository.filepath(result.path), inserted, signatures)
+                continue
+
+            # The file changed, drop all rules it emitted during the previous build
+            reinsert.pop((source, result.path), None)
+            previous = manifest.pop(source, result.path)
+            if previous:
+                remove(source, result.path, previous)
+
+            # Not recorded in the manifest, as the file is only skipped while a preceding copy is present
+            if ResultStatus.DUPLICATE in result.status:
+                if args.log_duplicates:
+                    logger.warning('Skipped duplicate file: %s in %s, a preceding repository contains the same rules',
+                                   result.path, source)
+                continue
+
+            inserted = []
+            skipped = []
+            signatures = [] if near_duplicates is not None else None
+            for rule in result.rules:
+                if (source, rule.id) in ids:
+                    if args.log_duplicates:
+                        logger.warning('Found duplicate ID: %s in %s', rule.id, rule.source)
+                    if args.ignore_duplicates:
+                        skipped.append(rule.id)
+                        continue
+                ids.add(source, rule.id)
+                if incremental:
+                    holders.setdefault((source, rule.id), set()).add(result.path)
+                pending.append(rule.asdict())
+                inserted.append(rule.id)
+                if near_duplicates is not None:
+                    with measure('signature', source):
+                        value = signature(rule)
+                    if value is not None:
+                        near_duplicates.add(source, result.repository.filepath(result.path), rule.id, value)
+                    signatures.append(None if value is None else encode(value))
+
+            if len(pending) >= INSERT_BATCH_SIZE:
+                flush()
+
+            if result.digest is not None:
+                manifest.record(source, result.path, result.digest, inserted, signatures, skipped)
+
+        flush()
+        checkpoint('parsed')
+
+        # Drop the rules of all files that vanished from the repositories
+        for source, path, removed in manifest.prune(seen):
+            if args.verbose > 1:
+                logger.debug('Removing rules of deleted file %s', path)
+            reinsert.pop((source, path), None)
+            if removed:
+                remove(source, path, removed)
+
+        if reinsert:
+            restore(args, config, manifest, reinsert, pending, near_duplicates)
+            flush()
+
+        clusters = None
+        if near_duplicates is not None:
+            with measure('near_duplicates'):
+                clusters = near_duplicates.clusters()
+                writer.write_clusters(clusters)
+            logger.info('Found %d clusters of near-duplicate rules', len(clusters))
+
+        for repo in config.repositories:
+            manifest.set_revision(repo.id, repo.revision)
 
         elapsed_time = datetime.now(timezone.utc) - start_time
+        report = BuildReport(args.DATABASE, resolve_format(args), writer.count(), len(config.repositories),
+                             elapsed_time, None if clusters is None else len(clusters))
         logger.info('Finished database generation in %s resulting in %d rules from %d origins.',
-                    human_readable(elapsed_time), len(rules), len(list(config.repositories)))
-    finally:
-        db.close()
+                    human_readable(elapsed_time), report.rules, report.repositories)
 
-    return 0
+    if writer.updatable:
+        manifest.save()
+
+    if args.parse_cache:
+        evict(ParseCache(), args.parse_cache_size * 1024 * 1024, args)
+    if args.verify and args.verify_cache:
+        evict(VerificationCache(), VERIFY_CACHE_SIZE, args)
+
+    if timer is not None:
+        timer.write(args.stats_json)
+
+    return report
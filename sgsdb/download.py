@@ -0,0 +1,104 @@
+#      Semgrep-Search Database
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+import json
+import threading
+from pathlib import Path
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from sgsdb.util import logger
+
+CHUNK_SIZE = 1 << 16
+TIMEOUT = 30
+POOL_SIZE = 16
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """
+    Returns the session shared by all downloads, so connections to the same host are reused
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def _validators_path(filename: Path) -> Path:
+    return filename.with_name(f'{filename.name}.json')
+
+
+def _conditional_headers(url: str, filename: Path) -> dict[str, str]:
+    try:
+        with _validators_path(filename).open('r') as fin:
+            validators = json.load(fin)
+    except (OSError, ValueError):
+        return {}
+
+    if validators.get('url') != url:
+        return {}
+
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+
+def download(args: argparse.Namespace, url: str, filename: Path) -> None:
+    """
+    Streams the file at url to filename. With --cache an existing file is only revalidated using the ETag and
+    Last-Modified headers of the previous download.
+    """
+    filename.parent.mkdir(exist_ok=True, parents=True)
+    cached = args.cache and filename.exists()
+
+    headers = _conditional_headers(url, filename) if cached else {}
+
+    try:
+        with get_session().get(url, headers=headers, stream=True, timeout=TIMEOUT) as r:
+            if r.status_code == requests.codes.not_modified:
+                logger.debug('Cached archive of %s is up to date', url)
+                return
+            r.raise_for_status()
+
+            partial = filename.with_name(f'{filename.name}.part')
+            with partial.open('wb') as fout:
+                for chunk in r.iter_content(CHUNK_SIZE):
+                    fout.write(chunk)
+            partial.replace(filename)
+
+            with _validators_path(filename).open('w') as fout:
+                json.dump({
+                    'url': url,
+                    'etag': r.headers.get('ETag'),
+                    'last_modified': r.headers.get('Last-Modified'),
+                }, fout)
+    except requests.RequestException as e:
+        if not cached:
+            raise
+        logger.warning('Could not revalidate %s, using the cached archive: %s', url, str(e))
+
@@ -0,0 +1,77 @@
+#      Semgrep-Search Database
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import threading
+from typing import Hashable, Iterable
+
+
+class DuplicateIndex:
+    """
+    Keeps track of the rule IDs in the database. Rules are either identified by their ID alone ('id') or by the
+    repository they stem from and their ID ('source').
+    """
+
+    def __init__(self, key: str) -> None:
+        self.by_source = key == 'source'
+        self.keys: set[Hashable] = set()
+
+    def key(self, source: str, rule_id: str) -> Hashable:
+        return (source, rule_id) if self.by_source else rule_id
+
+    def __contains__(self, rule: tuple[str, str]) -> bool:
+        return self.key(*rule) in self.keys
+
+    def add(self, source: str, rule_id: str) -> None:
+        self.keys.add(self.key(source, rule_id))
+
+    def update(self, source: str, rule_ids: Iterable[str]) -> None:
+        self.keys.update(self.key(source, rule_id) for rule_id in rule_ids)
+
+    def update_all(self, rules: Iterable[tuple[str, str]]) -> None:
+        self.keys.update(self.key(source, rule_id) for source, rule_id in rules)
+
+
+class ContentClaims:
+    """
+    Remembers the repository that first read a file of a certain content hash. A file with the same content as a file
+    of a repository that takes precedence only yields rules with the same IDs, so it does not need to be parsed when
+    duplicates are ignored. Repositories take precedence in the order they are passed.
+    """
+
+    def __init__(self, repo_ids: list[str]) -> None:
+        self.ranks = {repo_id: rank for rank, repo_id in enumerate(repo_ids)}
+        self.claims: dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def claim(self, digest: str, repo_id: str) -> bool:
+        """
+        Claims the content for the repository, returns False if a repository that takes precedence claimed it already
+        """
+        rank = self.ranks[repo_id]
+        with self.lock:
+            owner = self.claims.get(digest)
+            if owner is None or rank < owner:
+                self.claims[digest] = rank
+        return owner is None or owner >= rank
+
+    def __getstate__(self) -> dict:
+        # Worker processes receive a snapshot of the claims made so far
+        with self.lock:
+            return {'ranks': self.ranks, 'claims': dict(self.claims)}
+
+    def __setstate__(self, state: dict) -> None:
+        self.ranks = state['ranks']
+        self.claims = state['claims']
+        self.lock = threading.Lock()
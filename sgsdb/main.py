@@ -20,9 +20,14 @@ import sys
 from pathlib import Path
 from typing import Callable
 
+import ruamel.yaml
+
 from sgsdb import build_db
+from sgsdb.database import BuildError
 from sgsdb.config import Configuration
-from sgsdb.util import build_logger
+from sgsdb.output import FORMATS
+from sgsdb.profiling import profile
+from sgsdb.util import build_logger, logger
 
 
 def range_limited_int(min_val: int, max_val: int) -> Callable[[str], int]:
@@ -47,34 +52,84 @@ def parse_args() -> argparse.Namespace:
 
     parser.add_argument('-V', '--verify', dest='verify', action='store_true', default=False,
                         help='Extended verification (run semgrep --validate for every rule before adding')
+    parser.add_argument('--verify-cache', dest='verify_cache', action='store_true', default=False,
+                        help='Remember the outcome of semgrep --validate between runs')
     parser.add_argument('-a', '--append', dest='append', action='store_true', default=False,
                         help='Append to the database instead of truncating')
+    parser.add_argument('-I', '--incremental', dest='incremental', action='store_true', default=False,
+                        help='Only parse files that changed since the last build of the database')
+    parser.add_argument('-f', '--format', dest='format', choices=list(FORMATS), default=None,
+                        help='Output format of the database (Defaults to tinydb when updating, json otherwise)')
+    parser.add_argument('--shard-by', dest='shard_by', choices=['repo', 'language'], default='repo',
+                        help='Group rule contents of the sharded format by repository or language (Defaults to repo)')
+    parser.add_argument('--compression', dest='compression', choices=['auto', 'zstd', 'gzip'], default='auto',
+                        help='Compression of the packed format, auto prefers zstd if installed (Defaults to auto)')
+    parser.add_argument('--near-duplicates', dest='near_duplicates', action='store_true', default=False,
+                        help='Record clusters of rules with near-duplicate patterns in the database')
+    parser.add_argument('--near-duplicate-threshold', dest='near_duplicate_threshold', type=float, default=0.9,
+                        help='Estimated similarity of patterns required for near-duplicates (Defaults to 0.9)')
     parser.add_argument('-d', '--log-duplicated', dest='log_duplicates', action='store_true', default=False,
                         help='Log duplicate IDs')
     parser.add_argument('-i', '--ignore-duplicates', dest='ignore_duplicates', action='store_true', default=False,
                         help='Do not add duplicate IDs to the database')
+    parser.add_argument('--duplicate-key', dest='duplicate_key', choices=['id', 'source'], default='id',
+                        help='Whether IDs have to be unique across all repositories or per repository (Defaults to id)')
     parser.add_argument('-q', '--quiet', dest='quiet', action='store_true', default=False,
                         help='Do not log errors found while parsing a rule file')
     parser.add_argument('-c', '--cache', dest='cache', action='store_true', default=False,
-                        help='Only download repository data if not already present')
+                        help='Only revalidate cached repository data instead of downloading it again')
+    parser.add_argument('-C', '--parse-cache', dest='parse_cache', action='store_true', default=False,
+                        help='Cache parsed rules between runs, so unchanged files do not have to be parsed again')
+    parser.add_argument('--parse-cache-size', dest='parse_cache_size', default=256, type=range_limited_int(1, 1 << 20),
+                        help='Maximum size of the parse cache in MiB (Defaults to 256)')
     parser.add_argument('-p', '--progress', dest='progress', action='store_true', default=False,
                         help='Show a progress bar while processing data')
     parser.add_argument('-t', '--threads', dest='threads', default=multiprocessing.cpu_count(),
                         type=range_limited_int(1, 2 * multiprocessing.cpu_count()),
                         help='Use the specified number of threads for processing (Defaults to CPU count)')
+    parser.add_argument('-P', '--pipeline-depth', dest='pipeline_depth', default=2, type=range_limited_int(1, 64),
+                        help='Number of repositories that are processed concurrently (Defaults to 2)')
+    parser.add_argument('-Q', '--queue-size', dest='queue_size', default=64, type=range_limited_int(1, 1 << 16),
+                        help='Maximum number of files of a repository waiting for processing (Defaults to 64)')
+    parser.add_argument('-e', '--executor', dest='executor', choices=['thread', 'process'], default='thread',
+                        help='Parse rule files in threads or in worker processes (Defaults to thread)')
+    parser.add_argument('-y', '--yaml-engine', dest='yaml_engine', choices=['rt', 'fast'], default='rt',
+                        help='Parse rules with the round-trip or the libyaml backed safe YAML engine. The fast engine '
+                             'stores the same rules, but formats their content differently, e.g. anchors are expanded '
+                             'and block scalars become quoted strings (Defaults to rt)')
+    parser.add_argument('--stats-json', dest='stats_json', type=Path, default=None, metavar='PATH',
+                        help='Write the time spent in every stage per repository and worker to a JSON file')
+    parser.add_argument('--profile', dest='profile', choices=['cpu', 'mem'], default=None,
+                        help='Profile the build with cProfile or tracemalloc, results are written next to the database')
+    parser.add_argument('--profile-top', dest='profile_top', default=25, type=range_limited_int(1, 1000),
+                        help='Number of entries in the profile summaries (Defaults to 25)')
     parser.add_argument('-v', '--verbose', dest='verbose', action='count', default=0,
                         help='Enable verbose logging')
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.format is not None and (args.append or args.incremental) and not FORMATS[args.format].updatable:
+        parser.error(f'--append and --incremental are not supported by the {args.format} format')
+    if not 0 < args.near_duplicate_threshold <= 1:
+        parser.error('--near-duplicate-threshold has to be between 0 and 1')
+
+    return args
 
 
 def main() -> int:
     args = parse_args()
     build_logger(args)
 
+    if args.yaml_engine == 'fast' and not ruamel.yaml.__with_libyaml__:
+        logger.warning('ruamel.yaml.clib is not available, the fast YAML engine uses the pure Python implementation')
+
     config = Configuration(Path('config.yaml'))
 
-    return build_db(args, config)
+    try:
+        with profile(args):
+            return build_db(args, config)
+    except BuildError:
+        # Logged already
+        return 1
 
 
 if __name__ == '__main__':
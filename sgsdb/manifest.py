@@ -0,0 +1,145 @@
+#      Semgrep-Search Database
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import json
+from pathlib import Path
+from typing import Optional, Generator
+
+from sgsdb.util import logger
+
+
+class Manifest:
+    """
+    Keeps track of the rules emitted for every file of every repository, keyed on the content hash of the file
+    """
+
+    def __init__(self, path: Path, fingerprint: dict) -> None:
+        self.path = path
+        self.fingerprint = fingerprint
+        self.repositories: dict[str, dict[str, dict]] = {}
+        # Revision of every repository the files were taken from, for origins that know about revisions
+        self.revisions: dict[str, str] = {}
+
+    @staticmethod
+    def load(path: Path, fingerprint: dict) -> 'Manifest':
+        manifest = Manifest(path, fingerprint)
+        if not path.exists():
+            return manifest
+
+        try:
+            with path.open('r') as fin:
+                data = json.load(fin)
+        except Exception as e:
+            logger.warning('Ignoring unreadable manifest %s: %s', path, str(e))
+            return manifest
+
+        # Files parsed by a different version or with different settings have to be parsed again
+        if data.get('fingerprint') != fingerprint:
+            logger.info('Manifest %s was created with different settings, rebuilding all files', path)
+            return manifest
+
+        manifest.repositories = data.get('repositories', {})
+        manifest.revisions = data.get('revisions', {})
+        return manifest
+
+    def save(self) -> None:
+        with self.path.open('w') as fout:
+            json.dump({'fingerprint': self.fingerprint, 'repositories': self.repositories, 'revisions': self.revisions},
+                      fout)
+
+    def invalidate(self) -> None:
+        """
+        Removes the manifest from disk, so an interrupted build cannot be mistaken for a complete one
+        """
+        self.path.unlink(missing_ok=True)
+
+    def clear(self) -> None:
+        self.repositories = {}
+        self.revisions = {}
+
+    def __bool__(self) -> bool:
+        return bool(self.repositories)
+
+    def files(self, repo_id: str) -> dict[str, str]:
+        """
+        Returns the known content hash for every file of the repository
+        """
+        return {path: entry['hash'] for path, entry in self.repositories.get(repo_id, {}).items()}
+
+    def rules(self, repo_id: str, path: str) -> list[str]:
+        return self.repositories.get(repo_id, {}).get(path, {}).get('rules', [])
+
+    def skipped(self, repo_id: str, path: str) -> list[str]:
+        """
+        Returns the rules of the file that were not inserted, as a preceding rule had the same ID
+        """
+        return self.repositories.get(repo_id, {}).get(path, {}).get('skipped', [])
+
+    def holders(self) -> dict[tuple[str, str], set[str]]:
+        """
+        Returns the files whose rules were inserted, keyed on the repository and the ID of the rules
+        """
+        holders = {}
+        for repo_id, files in self.repositories.items():
+            for path, entry in files.items():
+                for rule_id in entry['rules']:
+                    holders.setdefault((repo_id, rule_id), set()).add(path)
+        return holders
+
+    def lookup(self, repo_id: str, path: str, digest: str) -> Optional[list[str]]:
+        entry = self.repositories.get(repo_id, {}).get(path)
+        if entry is None or entry['hash'] != digest:
+            return None
+        return entry['rules']
+
+    def revision(self, repo_id: str) -> Optional[str]:
+        return self.revisions.get(repo_id)
+
+    def set_revision(self, repo_id: str, revision: Optional[str]) -> None:
+        if revision is None:
+            self.revisions.pop(repo_id, None)
+        else:
+            self.revisions[repo_id] = revision
+
+    def signatures(self, repo_id: str, path: str) -> list[Optional[str]]:
+        """
+        Returns the encoded similarity signature of every rule of the file, if near-duplicate detection was enabled
+        """
+        return self.repositories.get(repo_id, {}).get(path, {}).get('signatures', [])
+
+    def record(self, repo_id: str, path: str, digest: str, rules: list[str],
+               signatures: Optional[list[Optional[str]]] = None, skipped: Optional[list[str]] = None) -> None:
+        entry = {'hash': digest, 'rules': rules}
+        if signatures is not None:
+            entry['signatures'] = signatures
+        if skipped:
+            entry['skipped'] = skipped
+        self.repositories.setdefault(repo_id, {})[path] = entry
+
+    def pop(self, repo_id: str, path: str) -> list[str]:
+        entry = self.repositories.get(repo_id, {}).pop(path, None)
+        return [] if entry is None else entry['rules']
+
+    def prune(self, seen: set[tuple[str, str]]) -> Generator[tuple[str, str, list[str]], None, None]:
+        """
+        Removes all files that have not been seen during the current build and yields the rules they emitted
+        """
+        for repo_id in list(self.repositories):
+            files = self.repositories[repo_id]
+            for path in [path for path in files if (repo_id, path) not in seen]:
+                yield repo_id, path, files.pop(path)['rules']
+            if not files:
+                del self.repositories[repo_id]
+                self.revisions.pop(repo_id, None)
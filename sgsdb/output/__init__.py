@@ -0,0 +1,54 @@
+#      Semgrep-Search Database
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+from typing import Type
+
+from sgsdb.output.base import DatabaseWriter
+from sgsdb.output.packed import PackedWriter, load_packed
+from sgsdb.output.sharded import ShardedWriter
+from sgsdb.output.sqlite import SQLiteWriter
+from sgsdb.output.stream import JSONStreamWriter
+from sgsdb.output.tiny import TinyDBWriter
+
+FORMATS: dict[str, Type[DatabaseWriter]] = {
+    'json': JSONStreamWriter,
+    'tinydb': TinyDBWriter,
+    'sharded': ShardedWriter,
+    'sqlite': SQLiteWriter,
+    'packed': PackedWriter,
+}
+
+
+def resolve_format(args: argparse.Namespace) -> str:
+    """
+    Returns the output format, updating an existing database requires a format that supports it
+    """
+    if args.format is not None:
+        return args.format
+    return 'tinydb' if args.append or args.incremental else 'json'
+
+
+def open_writer(args: argparse.Namespace) -> DatabaseWriter:
+    return FORMATS[resolve_format(args)](args)
+
+
+__all__ = [
+    'DatabaseWriter',
+    'FORMATS',
+    'load_packed',
+    'open_writer',
+    'resolve_format',
+]
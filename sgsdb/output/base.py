@@ -0,0 +1,81 @@
+#      Semgrep-Search Database
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+from types import TracebackType
+from typing import Iterable, Optional, Type, Self
+
+
+class DatabaseWriter:
+    """
+    Base class of all output formats the database can be written in
+    """
+
+    # Whether rules of an existing database can be kept and updated (required for --append and --incremental)
+    updatable: bool = False
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+
+    def write_meta(self, metadata: dict) -> None:
+        raise NotImplementedError
+
+    def write_repos(self, repos: list[dict]) -> None:
+        raise NotImplementedError
+
+    def clear_rules(self) -> None:
+        """
+        Removes all rules of an existing database, formats that always start from scratch do not need to do anything
+        """
+
+    def insert_rules(self, rules: list[dict]) -> None:
+        raise NotImplementedError
+
+    def remove_rules(self, source: str, ids: list[str]) -> None:
+        raise NotImplementedError(f'{self.__class__.__name__} does not support removing rules')
+
+    def rule_ids(self) -> Iterable[tuple[str, str]]:
+        """
+        Returns the source and ID of every rule in an existing database
+        """
+        raise NotImplementedError(f'{self.__class__.__name__} does not support reading rules')
+
+    def write_clusters(self, clusters: list[dict]) -> None:
+        """
+        Replaces the clusters of near-duplicate rules, called once all rules have been written
+        """
+        raise NotImplementedError(f'{self.__class__.__name__} does not support near-duplicate clusters')
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        raise NotImplementedError
+
+    def abort(self) -> None:
+        """
+        Called instead of close if the build failed
+        """
+        self.close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, exc_type: Optional[Type[BaseException]], exc_val: Optional[BaseException],
+                 exc_tb: Optional[TracebackType]) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,255 @@
+#      Semgrep-Search Database
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+import gzip
+import hashlib
+import json
+import shutil
+from pathlib import Path
+from typing import IO, Optional
+
+from sgsdb.output.base import DatabaseWriter
+from sgsdb.util import logger
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+PACKED_VERSION = 1
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+GZIP_MAGIC = b'\x1f\x8b'
+
+ZSTD_LEVEL = 19
+GZIP_LEVEL = 9
+
+
+def resolve_compression(compression: str) -> str:
+    """
+    Returns the codec used for writing, zstd requires the optional zstandard package
+    """
+    if compression == 'gzip':
+        return 'gzip'
+    if zstandard is None:
+        if compression == 'zstd':
+            logger.warning('zstandard is not installed, compressing the database with gzip instead')
+        return 'gzip'
+    return 'zstd'
+
+
+def open_compressed(path: Path, mode: str, compression: Optional[str] = None) -> IO[str]:
+    """
+    Opens a compressed text file, the codec of an existing file is detected from its magic bytes
+    """
+    if mode == 'r':
+        with path.open('rb') as fin:
+            compression = 'zstd' if fin.read(len(ZSTD_MAGIC)) == ZSTD_MAGIC else 'gzip'
+    if compression == 'zstd':
+        if zstandard is None:
+            raise RuntimeError(f'{path} is compressed with zstd, which requires the zstandard package')
+        return zstandard.open(path, f'{mode}t', cctx=zstandard.ZstdCompressor(level=ZSTD_LEVEL), encoding='utf8')
+    return gzip.open(path, f'{mode}t', compresslevel=GZIP_LEVEL, encoding='utf8')
+
+
+def _lines(text: str) -> list[str]:
+    # Unlike str.splitlines, only splits at line feeds, which may not be the only line breaks within a scalar
+    lines = text.split('\n')
+    return [f'{line}\n' for line in lines[:-1]] + ([lines[-1]] if lines[-1] else [])
+
+
+def _indent(line: str) -> int:
+    return len(line) - len(line.lstrip(' '))
+
+
+def _block_end(lines: list[str], start: int) -> int:
+    """
+    Returns the end of the block of the mapping key at start, consisting of the key and all lines nested below it
+    """
+    indent = _indent(lines[start])
+    end = start + 1
+    for i in range(start + 1, len(lines)):
+        line = lines[i]
+        if not line.strip():
+            continue
+        # Block sequences may start at the indentation of their key
+        nested = line.lstrip(' ')
+        if _indent(line) < indent or (_indent(line) == indent and not nested.startswith(('- ', '-\n'))):
+            break
+        end = i + 1
+    return end
+
+
+def _find_key(lines: list[str], start: int, end: int, key: str) -> Optional[int]:
+    """
+    Returns the line of the key within the mapping spanning start to end, the first line determines its indentation
+    """
+    indent = next((_indent(line) for line in lines[start:end] if line.strip()), None)
+    for i in range(start, end):
+        if _indent(lines[i]) == indent and lines[i][indent:].startswith(f'{key}:'):
+            return i
+    return None
+
+
+def split_source(content: str) -> tuple[str, list[list[int | str]]]:
+    """
+    Removes the blocks Rule.from_file adds to the metadata of every rule (semgrep-search and the origin of
+    semgrep.dev.rule) from the dumped content, as they differ for copies of a rule in different repositories. Returns
+    the remaining body and every removed block along with the line it started at.
+    """
+    lines = _lines(content)
+    blocks = []
+    metadata = _find_key(lines, 0, len(lines), 'metadata')
+    if metadata is not None:
+        metadata_end = _block_end(lines, metadata)
+        search = _find_key(lines, metadata + 1, metadata_end, 'semgrep-search')
+        if search is not None:
+            blocks.append((search, _block_end(lines, search)))
+        path = [_find_key(lines, metadata + 1, metadata_end, 'semgrep.dev')]
+        for key in ('rule', 'origin'):
+            if path[-1] is None:
+                break
+            path.append(_find_key(lines, path[-1] + 1, _block_end(lines, path[-1]), key))
+        if path[-1] is not None:
+            blocks.append((path[-1], _block_end(lines, path[-1])))
+
+    removed = set()
+    for start, end in blocks:
+        removed.update(range(start, end))
+    body = ''.join(line for i, line in enumerate(lines) if i not in removed)
+    return body, [[start, ''.join(lines[start:end])] for start, end in sorted(blocks)]
+
+
+def merge_source(body: str, blocks: list[list[int | str]]) -> str:
+    """
+    Reverses split_source
+    """
+    lines = _lines(body)
+    for start, block in blocks:
+        lines[start:start] = _lines(block)
+    return ''.join(lines)
+
+
+class PackedWriter(DatabaseWriter):
+    """
+    Writes the database in the TinyDB JSON layout into a single compressed file. Every distinct rule body is stored
+    once in the additional contents list and rules refer to it by its position, so rules vendored by multiple
+    repositories do not increase the size of the database. The metadata identifying the repository of a rule is kept
+    on the rule (source_blocks), as it would make every body distinct. Bodies are deduplicated by their hash, which is
+    only kept while writing, as hashes do not compress and would cost more than they save.
+
+        {"packed": {version, compression}, "meta": {...}, "repos": {...},
+         "rules": {"<doc id>": {..., "content": <index>, "source_blocks": [[<line>, "<block>"], ...]}},
+         "clusters": {...}, "contents": ["<body>", ...]}
+
+    Use load_packed for reading the database back.
+    """
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        super().__init__(args)
+        self.compression = resolve_compression(args.compression)
+        self.path = Path(args.DATABASE)
+        self.tmp_path = self.path.with_name(f'{self.path.name}.tmp')
+        self.fout = open_compressed(self.tmp_path, 'w', self.compression)
+        # Bodies are collected uncompressed next to the database and appended once all rules have been written
+        self.contents_path = self.path.with_name(f'{self.path.name}.contents.tmp')
+        self.contents = self.contents_path.open('w+', encoding='utf8')
+        self.digests: dict[bytes, int] = {}
+        self.tables: dict[str, list[dict]] = {'meta': [], 'repos': []}
+        self.clusters: Optional[list[dict]] = None
+        self.started = False
+        self.rules = 0
+
+    @staticmethod
+    def _table(docs: list[dict]) -> str:
+        return json.dumps({str(doc_id): doc for doc_id, doc in enumerate(docs, start=1)})
+
+    def _start_rules(self) -> None:
+        if self.started:
+            return
+        self.started = True
+        packed = {'version': PACKED_VERSION, 'compression': self.compression}
+        self.fout.write(f'{{"packed": {json.dumps(packed)}, ')
+        for name, docs in self.tables.items():
+            self.fout.write(f'{json.dumps(name)}: {self._table(docs)}, ')
+        self.fout.write('"rules": {')
+
+    def write_meta(self, metadata: dict) -> None:
+        self.tables['meta'] = [metadata]
+
+    def write_repos(self, repos: list[dict]) -> None:
+        self.tables['repos'] = repos
+
+    def insert_rules(self, rules: list[dict]) -> None:
+        self._start_rules()
+        for rule in rules:
+            body, blocks = split_source(rule['content'])
+            digest = hashlib.sha256(body.encode('utf8')).digest()
+            index = self.digests.get(digest)
+            if index is None:
+                index = self.digests[digest] = len(self.digests)
+                self.contents.write(f'{", " if index else ""}{json.dumps(body)}')
+            if self.rules > 0:
+                self.fout.write(', ')
+            self.rules += 1
+            self.fout.write(f'"{self.rules}": {json.dumps({**rule, "content": index, "source_blocks": blocks})}')
+
+    def write_clusters(self, clusters: list[dict]) -> None:
+        self.clusters = clusters
+
+    def count(self) -> int:
+        return self.rules
+
+    def close(self) -> None:
+        self._start_rules()
+        self.fout.write('}')
+        if self.clusters is not None:
+            self.fout.write(f', "clusters": {self._table(self.clusters)}')
+        self.fout.write(', "contents": [')
+        self.contents.seek(0)
+        shutil.copyfileobj(self.contents, self.fout)
+        self.fout.write(']}')
+        self.fout.close()
+        self.contents.close()
+        self.contents_path.unlink()
+        self.tmp_path.replace(self.path)
+        logger.info('Stored %d distinct rule bodies for %d rules', len(self.digests), self.rules)
+
+    def abort(self) -> None:
+        # Keep the previous database instead of replacing it with an incomplete one
+        self.fout.close()
+        self.contents.close()
+        self.tmp_path.unlink(missing_ok=True)
+        self.contents_path.unlink(missing_ok=True)
+
+
+def load_packed(path: Path, *, resolve: bool = True) -> dict:
+    """
+    Reads a database written by the packed format and returns it in the TinyDB JSON layout. Unless resolve is False,
+    the content references are replaced by the original rule contents again and the contents table is dropped.
+    """
+    with open_compressed(Path(path), 'r') as fin:
+        data = json.load(fin)
+    if data.get('packed', {}).get('version') != PACKED_VERSION:
+        raise ValueError(f'{path} is not a packed database of version {PACKED_VERSION}')
+    if not resolve:
+        return data
+
+    contents = data.pop('contents')
+    del data['packed']
+    for rule in data['rules'].values():
+        rule['content'] = merge_source(contents[rule['content']], rule.pop('source_blocks'))
+    return data
@@ -0,0 +1,150 @@
+#      Semgrep-Search Database
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+import hashlib
+import json
+import re
+import shutil
+from pathlib import Path
+from typing import Optional, TextIO
+
+from sgsdb.output.base import DatabaseWriter
+
+RE_UNSAFE = re.compile(r'[^A-Za-z0-9_.-]')
+
+
+class JSONObjectFile:
+    """
+    Streams the members of a JSON object to a file, while keeping track of the hash and size of the written data
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.fout: TextIO = path.open('w')
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.members = 0
+        self._write('{')
+
+    def _write(self, data: str) -> None:
+        encoded = data.encode('utf8')
+        self.hash.update(encoded)
+        self.size += len(encoded)
+        self.fout.write(data)
+
+    def add(self, key: str, value: str) -> None:
+        """
+        Adds a member, the value has to be serialized already
+        """
+        self._write(f'{", " if self.members else ""}{json.dumps(key)}: {value}')
+        self.members += 1
+
+    def close(self) -> dict:
+        self._write('}')
+        self.fout.close()
+        return {'sha256': self.hash.hexdigest(), 'size': self.size}
+
+
+class ShardedWriter(DatabaseWriter):
+    """
+    Writes the database into a directory: a compact index of all rules without their content, content shards grouped
+    by repository or language, and a manifest listing the hash of every file. Clients only need the index to list and
+    filter rules and fetch the content of a shard once it is required.
+
+        manifest.json            meta, repos, clusters and the files below with their hashes
+        index.json               {"<doc id>": {id, source, severity, languages, category, description, shard}}
+        shards/<key>.json        {"<doc id>": "<content>"}
+    """
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        super().__init__(args)
+        self.shard_by = args.shard_by
+        self.path = Path(args.DATABASE)
+        self.tmp_path = self.path.with_name(f'{self.path.name}.tmp')
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        (self.tmp_path / 'shards').mkdir(parents=True)
+
+        self.meta: dict = {}
+        self.repos: list[dict] = []
+        self.index = JSONObjectFile(self.tmp_path / 'index.json')
+        self.shards: dict[str, JSONObjectFile] = {}
+        self.clusters: Optional[list[dict]] = None
+        self.rules = 0
+
+    def write_meta(self, metadata: dict) -> None:
+        self.meta = metadata
+
+    def write_repos(self, repos: list[dict]) -> None:
+        self.repos = repos
+
+    def _shard_key(self, rule: dict) -> str:
+        if self.shard_by == 'language':
+            # Rules for multiple languages are stored once, in the shard of their first language
+            return min(rule['languages'], default='generic')
+        return rule['source']
+
+    def _shard(self, key: str) -> JSONObjectFile:
+        shard = self.shards.get(key)
+        if shard is None:
+            shard = self.shards[key] = JSONObjectFile(self.tmp_path / 'shards' / f'{RE_UNSAFE.sub("_", key)}.json')
+        return shard
+
+    def insert_rules(self, rules: list[dict]) -> None:
+        for rule in rules:
+            self.rules += 1
+            doc_id = str(self.rules)
+            key = self._shard_key(rule)
+            self._shard(key).add(doc_id, json.dumps(rule['content']))
+            entry = {name: value for name, value in rule.items() if name != 'content'}
+            entry['shard'] = key
+            self.index.add(doc_id, json.dumps(entry))
+
+    def write_clusters(self, clusters: list[dict]) -> None:
+        self.clusters = clusters
+
+    def count(self) -> int:
+        return self.rules
+
+    def _file(self, file: JSONObjectFile) -> dict:
+        return {'file': file.path.relative_to(self.tmp_path).as_posix(), 'rules': file.members, **file.close()}
+
+    def close(self) -> None:
+        manifest = {
+            'meta': self.meta,
+            'repos': self.repos,
+            'shard_by': self.shard_by,
+            'index': self._file(self.index),
+            'shards': {key: self._file(shard) for key, shard in sorted(self.shards.items())},
+        }
+        if self.clusters is not None:
+            manifest['clusters'] = self.clusters
+        with (self.tmp_path / 'manifest.json').open('w') as fout:
+            json.dump(manifest, fout, indent=2)
+
+        # Swap the directories, so readers never see a partially written database
+        old_path = self.path.with_name(f'{self.path.name}.old')
+        shutil.rmtree(old_path, ignore_errors=True)
+        if self.path.exists():
+            self.path.replace(old_path)
+        self.tmp_path.replace(self.path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    def abort(self) -> None:
+        # Keep the previous database instead of replacing it with an incomplete one
+        self.index.fout.close()
+        for shard in self.shards.values():
+            shard.fout.close()
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
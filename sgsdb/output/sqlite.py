@@ -0,0 +1,125 @@
+#      Semgrep-Search Database
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+import json
+import sqlite3
+from typing import Iterable
+
+from sgsdb.output.base import DatabaseWriter
+from sgsdb.util import logger
+
+SCHEMA_VERSION = 1
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)',
+    ('CREATE TABLE IF NOT EXISTS repos (id TEXT PRIMARY KEY, name TEXT NOT NULL, license TEXT, type TEXT, url TEXT, '
+     'data TEXT NOT NULL)'),
+    ('CREATE TABLE IF NOT EXISTS rules (rowid INTEGER PRIMARY KEY, source TEXT NOT NULL, id TEXT NOT NULL, '
+     'severity TEXT, category TEXT, description TEXT, content TEXT NOT NULL)'),
+    ('CREATE TABLE IF NOT EXISTS rule_languages (rule INTEGER NOT NULL REFERENCES rules (rowid) ON DELETE CASCADE, '
+     'language TEXT NOT NULL, PRIMARY KEY (rule, language)) WITHOUT ROWID'),
+    ('CREATE TABLE IF NOT EXISTS clusters (cluster INTEGER NOT NULL, source TEXT NOT NULL, file TEXT NOT NULL, '
+     'id TEXT NOT NULL, PRIMARY KEY (cluster, source, file, id)) WITHOUT ROWID'),
+    'CREATE INDEX IF NOT EXISTS rules_source_id ON rules (source, id)',
+    'CREATE INDEX IF NOT EXISTS rules_severity ON rules (severity)',
+    'CREATE INDEX IF NOT EXISTS rules_category ON rules (category)',
+    'CREATE INDEX IF NOT EXISTS rule_languages_language ON rule_languages (language, rule)',
+    'CREATE INDEX IF NOT EXISTS clusters_source_id ON clusters (source, id)',
+]
+
+# External content table, the index is rebuilt from the rules table once all rules have been written
+FTS_SCHEMA = ("CREATE VIRTUAL TABLE IF NOT EXISTS rules_fts USING fts5 (id, description, content, content='rules', "
+              "content_rowid='rowid')")
+
+
+class SQLiteWriter(DatabaseWriter):
+    """
+    Writes the database as SQLite database with indexes on all columns rules are filtered by and a full text index
+    over id, description and content, so clients can query rules instead of loading and scanning all of them. The
+    whole build is written in a single transaction.
+    """
+    updatable = True
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        super().__init__(args)
+        self.conn = sqlite3.connect(args.DATABASE, isolation_level=None)
+        self.conn.execute('PRAGMA foreign_keys=ON')
+        # A failed build rolls back the transaction, syncing the database is only required once it is complete
+        self.conn.execute('PRAGMA synchronous=OFF')
+        self.conn.execute('BEGIN')
+        for statement in SCHEMA:
+            self.conn.execute(statement)
+        try:
+            self.conn.execute(FTS_SCHEMA)
+            self.fts = True
+        except sqlite3.OperationalError as e:
+            logger.warning('SQLite was built without FTS5, skipping the full text index: %s', str(e))
+            self.fts = False
+        self.conn.execute(f'PRAGMA user_version={SCHEMA_VERSION}')
+
+    def write_meta(self, metadata: dict) -> None:
+        self.conn.execute('DELETE FROM meta')
+        self.conn.executemany('INSERT INTO meta (key, value) VALUES (?, ?)',
+                              [(key, json.dumps(value)) for key, value in metadata.items()])
+
+    def write_repos(self, repos: list[dict]) -> None:
+        self.conn.execute('DELETE FROM repos')
+        self.conn.executemany('INSERT INTO repos (id, name, license, type, url, data) VALUES (?, ?, ?, ?, ?, ?)', [
+            (repo['id'], repo['name'], repo.get('license'), repo.get('type'), repo.get('url'), json.dumps(repo))
+            for repo in repos
+        ])
+
+    def clear_rules(self) -> None:
+        self.conn.execute('DELETE FROM rule_languages')
+        self.conn.execute('DELETE FROM rules')
+        self.conn.execute('DELETE FROM clusters')
+
+    def insert_rules(self, rules: list[dict]) -> None:
+        languages = []
+        for rule in rules:
+            cursor = self.conn.execute(
+                'INSERT INTO rules (source, id, severity, category, description, content) VALUES (?, ?, ?, ?, ?, ?)',
+                (rule['source'], rule['id'], rule['severity'], rule['category'], rule['description'], rule['content']))
+            languages.extend((cursor.lastrowid, language) for language in set(rule['languages']))
+        self.conn.executemany('INSERT INTO rule_languages (rule, language) VALUES (?, ?)', languages)
+
+    def remove_rules(self, source: str, ids: list[str]) -> None:
+        # Languages of the removed rules are removed by the foreign key
+        self.conn.executemany('DELETE FROM rules WHERE source = ? AND id = ?', [(source, rule_id) for rule_id in ids])
+
+    def rule_ids(self) -> Iterable[tuple[str, str]]:
+        return self.conn.execute('SELECT source, id FROM rules')
+
+    def write_clusters(self, clusters: list[dict]) -> None:
+        self.conn.execute('DELETE FROM clusters')
+        self.conn.executemany('INSERT OR IGNORE INTO clusters (cluster, source, file, id) VALUES (?, ?, ?, ?)', [
+            (number, rule['source'], rule['file'], rule['id'])
+            for number, cluster in enumerate(clusters, start=1) for rule in cluster['rules']
+        ])
+
+    def count(self) -> int:
+        return self.conn.execute('SELECT COUNT(*) FROM rules').fetchone()[0]
+
+    def close(self) -> None:
+        if self.fts:
+            self.conn.execute("INSERT INTO rules_fts (rules_fts) VALUES ('rebuild')")
+        self.conn.execute('COMMIT')
+        self.conn.execute('PRAGMA optimize')
+        self.conn.close()
+
+    def abort(self) -> None:
+        self.conn.execute('ROLLBACK')
+        self.conn.close()
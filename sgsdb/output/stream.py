@@ -0,0 +1,84 @@
+#      Semgrep-Search Database
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+import json
+from pathlib import Path
+from typing import Optional
+
+from sgsdb.output.base import DatabaseWriter
+
+
+class JSONStreamWriter(DatabaseWriter):
+    """
+    Writes the database in the TinyDB JSON layout, streaming every rule to disk instead of keeping it in memory
+    """
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        super().__init__(args)
+        self.path = Path(args.DATABASE)
+        self.tmp_path = self.path.with_name(f'{self.path.name}.tmp')
+        self.fout = self.tmp_path.open('w')
+        self.tables: dict[str, list[dict]] = {'meta': [], 'repos': []}
+        self.clusters: Optional[list[dict]] = None
+        self.started = False
+        self.rules = 0
+
+    @staticmethod
+    def _table(docs: list[dict]) -> str:
+        return json.dumps({str(doc_id): doc for doc_id, doc in enumerate(docs, start=1)})
+
+    def _start_rules(self) -> None:
+        if self.started:
+            return
+        self.started = True
+        self.fout.write('{')
+        for name, docs in self.tables.items():
+            self.fout.write(f'{json.dumps(name)}: {self._table(docs)}, ')
+        self.fout.write('"rules": {')
+
+    def write_meta(self, metadata: dict) -> None:
+        self.tables['meta'] = [metadata]
+
+    def write_repos(self, repos: list[dict]) -> None:
+        self.tables['repos'] = repos
+
+    def insert_rules(self, rules: list[dict]) -> None:
+        self._start_rules()
+        for rule in rules:
+            if self.rules > 0:
+                self.fout.write(', ')
+            self.rules += 1
+            self.fout.write(f'"{self.rules}": {json.dumps(rule)}')
+
+    def write_clusters(self, clusters: list[dict]) -> None:
+        self.clusters = clusters
+
+    def count(self) -> int:
+        return self.rules
+
+    def close(self) -> None:
+        self._start_rules()
+        self.fout.write('}')
+        if self.clusters is not None:
+            self.fout.write(f', "clusters": {self._table(self.clusters)}')
+        self.fout.write('}')
+        self.fout.close()
+        self.tmp_path.replace(self.path)
+
+    def abort(self) -> None:
+        # Keep the previous database instead of replacing it with an incomplete one
+        self.fout.close()
+        self.tmp_path.unlink(missing_ok=True)
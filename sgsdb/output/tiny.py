@@ -0,0 +1,75 @@
+#      Semgrep-Search Database
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+from typing import Iterable
+
+from tinydb import TinyDB, Query
+from tinydb.middlewares import CachingMiddleware
+from tinydb.storages import JSONStorage
+
+from sgsdb.output.base import DatabaseWriter
+
+
+class TinyDBWriter(DatabaseWriter):
+    updatable = True
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        super().__init__(args)
+        self.db = TinyDB(args.DATABASE, storage=CachingMiddleware(JSONStorage))
+        self.rules = self.db.table('rules')
+
+    def write_meta(self, metadata: dict) -> None:
+        meta = self.db.table('meta')
+        meta.truncate()
+        meta.insert(metadata)
+
+    def write_repos(self, repos: list[dict]) -> None:
+        table = self.db.table('repos')
+        table.truncate()
+        for repo in repos:
+            table.upsert(repo, Query().id == repo['id'])
+
+        if isinstance(self.db.storage, CachingMiddleware):
+            self.db.storage.flush()
+
+    def clear_rules(self) -> None:
+        self.rules.truncate()
+        self.db.table('clusters').truncate()
+
+    def insert_rules(self, rules: list[dict]) -> None:
+        self.rules.insert_multiple(rules)
+
+    def remove_rules(self, source: str, ids: list[str]) -> None:
+        self.rules.remove((Query().source == source) & Query().id.one_of(ids))
+
+    def rule_ids(self) -> Iterable[tuple[str, str]]:
+        return [(rule['source'], rule['id']) for rule in self.rules]
+
+    def write_clusters(self, clusters: list[dict]) -> None:
+        table = self.db.table('clusters')
+        table.truncate()
+        table.insert_multiple(clusters)
+
+    def count(self) -> int:
+        return len(self.rules)
+
+    def close(self) -> None:
+        self.db.close()
+
+    def abort(self) -> None:
+        # Drop the cached writes instead of flushing them, anything flushed before the failure is kept though
+        storage = self.db.storage
+        (storage.storage if isinstance(storage, CachingMiddleware) else storage).close()
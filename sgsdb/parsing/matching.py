@@ -0,0 +1,40 @@
+#      Semgrep-Search Database
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import re
+
+from sgsdb.util import logger
+
+# Matches the YAML files of an archive that may contain rules, i.e. no test files and nothing within hidden files or
+# directories. The first path component is the directory the archive was packed from, its name is not checked.
+RE_RULE_PATH = re.compile(r'^[^/]+/(?!(?:[^/]*/)*\.)(?!.*\.test\.ya?ml$).*\.ya?ml$')
+
+
+class PathFilter:
+    """
+    Decides by name alone whether a file has to be processed, so ignored files never have to be read
+    """
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.verbose = args.verbose
+
+    def __call__(self, path: str) -> bool:
+        if RE_RULE_PATH.match(path):
+            return True
+        if self.verbose > 1:
+            logger.debug('Ignoring due to file name: %s', path)
+        return False
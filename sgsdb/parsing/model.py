@@ -15,7 +15,7 @@
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import enum
 from dataclasses import dataclass, field
-from typing import List, TYPE_CHECKING
+from typing import List, TYPE_CHECKING, Callable
 
 from sgsdb.parsing.statistic import ResultStatus
 from sgsdb.rule import Rule
@@ -23,15 +23,28 @@ from sgsdb.rule import Rule
 if TYPE_CHECKING:
     from sgsdb.repository import Repository
 
+# Reads the content of a file on demand, so files are only held in memory while they are being processed
+ContentLoader = Callable[[], bytes]
+
 
 @dataclass
 class ParsingResult:
     repository: 'Repository'
     path: str
-    content: str
+    content: bytes | None
     status: List[ResultStatus] = field(default_factory=list)
     data: dict | None = None
     rules: List[Rule] = field(default_factory=list)
+    digest: str | None = None
+    # Position of the file within the repository, used for emitting results in a deterministic order
+    index: int = 0
+
+    def release(self) -> None:
+        """
+        Drops the raw file and the parsed document once the rules have been built from them
+        """
+        self.content = None
+        self.data = None
 
 
 class RuleMode(enum.Enum):
@@ -14,10 +14,12 @@
 #      You should have received a copy of the GNU General Public License
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from contextvars import copy_context
+from functools import partial
 from queue import Queue, Full, Empty
 from threading import Thread
 from time import time
-from typing import TypeVar, Generic, Callable, Iterable, Optional
+from typing import TypeVar, Generic, Callable, Iterable, Optional, Generator
 
 T = TypeVar('T')
 
@@ -27,8 +29,8 @@ class Closed(Exception):
 
 
 class CloseableQueue(Queue, Generic[T]):
-    def __init__(self) -> None:
-        super().__init__()
+    def __init__(self, maxsize: int = 0) -> None:
+        super().__init__(maxsize)
         self._closed = False
 
     def close(self) -> None:
@@ -41,6 +43,14 @@ class CloseableQueue(Queue, Generic[T]):
         finally:
             self.mutex.release()
 
+    def drain(self) -> None:
+        """
+        Discards the items left in the queue, e.g. once its consumer stopped early
+        """
+        with self.mutex:
+            self.queue.clear()
+            self.not_full.notify_all()
+
     def closed(self) -> bool:
         self.mutex.acquire()
         try:
@@ -51,17 +61,18 @@ class CloseableQueue(Queue, Generic[T]):
     def put(self, item: T, *, block: bool = True, timeout: Optional[float] = None, last: bool = False) -> None:
         with self.not_full:
             if self.maxsize > 0:
+                # Closing the queue wakes up producers waiting for room, they raise Closed below
                 if not block:
-                    if self._qsize() >= self.maxsize:
+                    if self._qsize() >= self.maxsize and not self._closed:
                         raise Full
                 elif timeout is None:
-                    while self._qsize() >= self.maxsize:
+                    while self._qsize() >= self.maxsize and not self._closed:
                         self.not_full.wait()
                 elif timeout < 0:
                     raise ValueError("'timeout' must be a non-negative number")
                 else:
                     endtime = time() + timeout
-                    while self._qsize() >= self.maxsize:
+                    while self._qsize() >= self.maxsize and not self._closed:
                         remaining = endtime - time()
                         if remaining <= 0.0:
                             raise Full
@@ -109,21 +120,43 @@ def enqueue(it: Iterable, q: CloseableQueue, *, putargs: Optional[dict] = None,
             close: bool = True) -> None:
     if putargs is None:
         putargs = {}
-    for value in iter(it):
-        q.put(value, **putargs)
+    try:
+        for value in iter(it):
+            q.put(value, **putargs)
+    except Closed:
+        # The consumer closed the queue, nothing more is taken from it
+        return
     if close:
         q.close()
     if join:
         q.join()
 
 
+def in_context(target: Callable) -> Callable:
+    """
+    Binds the target to a copy of the current context, threads do not inherit context variables (e.g. the stage timer)
+    """
+    return partial(copy_context().run, target)
+
+
 def enqueue_thread(it: Iterable, q: CloseableQueue = None, *, name: str = 'enqueue', start: bool = True,
                    enqueue: Callable = enqueue, **kwargs) -> Thread:
     if q is None:
         q = CloseableQueue()
-    thread = Thread(name=name, target=enqueue, args=(it, q), kwargs=kwargs)
+    thread = Thread(name=name, target=in_context(enqueue), args=(it, q), kwargs=kwargs)
     thread.daemon = True
     thread.q = q
     if start:
         thread.start()
     return thread
+
+
+def chunked(it: Iterable[T], size: int) -> Generator[list[T], None, None]:
+    chunk = []
+    for value in iter(it):
+        chunk.append(value)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -15,17 +15,22 @@
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import argparse
-from typing import Generator, TYPE_CHECKING
-
-from ruamel.yaml import YAML
+import hashlib
+import json
+import threading
+from typing import Generator, TYPE_CHECKING, Optional
 
+from sgsdb.cache import ParseCache
 from sgsdb.parsing.model import ParsingResult
 from sgsdb.parsing.statistic import ResultStatus
-from sgsdb.parsing.validation import is_valid, validate_rule_file
+from sgsdb.parsing.validation import is_valid
 from sgsdb.rule import Rule
-from sgsdb.util import logger
+from sgsdb.timing import measure
+from sgsdb.util import logger, get_version, get_yaml
 
 if TYPE_CHECKING:
+    from ruamel.yaml import YAML
+
     from sgsdb.repository import Repository
 
 
@@ -34,10 +39,94 @@ class RuleParser:
     def __init__(self, args: argparse.Namespace, repo: 'Repository') -> None:
         self.args = args
         self.repo = repo
+        # Opened on first use, so processors that only dispatch to worker processes never hold a connection
+        self._cache: Optional[ParseCache] = None
+        self._cache_lock = threading.Lock()
+        # Everything besides the file itself that has an influence on the parsed rules
+        self.cache_salt = json.dumps([get_version(), args.yaml_engine, repo.to_dict()], sort_keys=True)
+
+    @property
+    def cache(self) -> Optional[ParseCache]:
+        with self._cache_lock:
+            if self._cache is None and self.args.parse_cache:
+                self._cache = ParseCache()
+            return self._cache
+
+    def close(self) -> None:
+        if self._cache is not None:
+            self._cache.close()
+
+    def _cache_key(self, result: ParsingResult) -> str:
+        return hashlib.sha256(f'{self.cache_salt}\0{result.path}\0{result.digest}'.encode('utf8')).hexdigest()
+
+    def _parse_fast(self, result: ParsingResult) -> Optional[list[Rule]]:
+        """
+        Parses the file using the libyaml backed safe loader and dumper. Returns None if the file has to be parsed
+        using the round-trip engine instead. The rules carry the same data, but their content is formatted by the safe
+        dumper, e.g. anchors are expanded and block scalars become quoted strings.
+        """
+        yaml = get_yaml('fast')
+        try:
+            with measure('yaml_load', self.repo.id):
+                data = yaml.load(result.content)
+        except Exception as e:
+            logger.debug(str(e), exc_info=e)
+            return None
+
+        # Let the round-trip engine report malformed files
+        if not isinstance(data, dict) or not isinstance(data.get('rules'), list):
+            return None
+
+        result.data = data
+        rules = list(self._process_rules(result, yaml, warn=False))
+        if ResultStatus.EXCEPTION in result.status:
+            return None
+
+        # The safe dumper has to reproduce the exact same data, otherwise the round-trip engine has to be used
+        for rule in rules:
+            with measure('yaml_check', self.repo.id):
+                reproduced = yaml.load(rule.content) == rule.data
+            if not reproduced:
+                if self.args.verbose > 1:
+                    logger.debug('Fast YAML output differs for %s, falling back', result.path)
+                return None
+
+        # Reported only now, as the round-trip engine reports them again if the file falls back
+        self._warn_invalid(result, result.status.count(ResultStatus.INVALID_RULE))
+        return rules
+
+    def _parse(self, result: ParsingResult) -> list[Rule]:
+        if self.args.yaml_engine == 'fast':
+            rules = self._parse_fast(result)
+            if rules is not None:
+                return rules
+            result.status = []
+            result.data = None
+
+        if not self._load_file(result):
+            return []
+        return list(self._process_rules(result))
+
+    def _parse_cached(self, result: ParsingResult) -> list[Rule]:
+        if self.cache is None or result.digest is None:
+            return self._parse(result)
+
+        key = self._cache_key(result)
+        with measure('parse_cache', self.repo.id):
+            cached = self.cache.get_result(key)
+        if cached is not None:
+            status, rules = cached
+            result.status = [ResultStatus(value) for value in status]
+            return [Rule.from_dict(rule) for rule in rules]
+
+        rules = self._parse(result)
+        self.cache.put_result(key, [status.value for status in result.status], [rule.asdict() for rule in rules])
+        return rules
 
     def _load_file(self, result: ParsingResult) -> bool:
         try:
-            data = YAML(typ='rt').load(result.content)
+            with measure('yaml_load', self.repo.id):
+                data = get_yaml().load(result.content)
             if 'rules' not in data:
                 if not self.args.quiet:
                     logger.warning('Found file without "rules" section: %s', result.path)
@@ -50,30 +139,33 @@ class RuleParser:
             result.status = [ResultStatus.INVALID_RULE]
         return False
 
-    def _process_rules(self, result: ParsingResult) -> Generator[Rule, None, None]:
+    def _warn_invalid(self, result: ParsingResult, count: int = 1) -> None:
+        if not self.args.quiet:
+            for _ in range(count):
+                logger.warning('Found invalid rule within file: %s', result.path)
+
+    def _process_rules(self, result: ParsingResult, yaml: Optional['YAML'] = None, *,
+                       warn: bool = True) -> Generator[Rule, None, None]:
         for rule in result.data['rules']:
-            if not is_valid(rule):
-                if not self.args.quiet:
-                    logger.warning('Found invalid rule within file: %s', result.path)
+            with measure('is_valid', self.repo.id):
+                valid = is_valid(rule)
+            if not valid:
+                if warn:
+                    self._warn_invalid(result)
                 result.status.append(ResultStatus.INVALID_RULE)
                 continue
             try:
-                yield Rule.from_file(self.repo, rule, result.path)
+                yield Rule.from_file(self.repo, rule, result.path, yaml)
             except Exception as e:
                 logger.debug(str(e), exc_info=e)
                 result.status = [ResultStatus.EXCEPTION]
 
     def process(self, result: ParsingResult) -> None:
-        if not self._load_file(result):
-            return
-
-        for rule in self._process_rules(result):
-            try:
-                if self.args.verify and not validate_rule_file(result.path, rule):
-                    result.status.append(ResultStatus.INVALID_RULE)
-                    continue
-                result.rules.append(rule)
-                result.status.append(ResultStatus.SUCCESS)
-            except Exception as e:
-                logger.debug(str(e), exc_info=e)
-                result.status.append(ResultStatus.EXCEPTION)
+        """
+        Parses the rules of a file. With --verify the rules still need to pass verification by the RuleProcessor before
+        they count as successful.
+        """
+        result.rules = self._parse_cached(result)
+        result.release()
+        if not self.args.verify:
+            result.status.extend(ResultStatus.SUCCESS for _ in result.rules)
@@ -15,83 +15,319 @@
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import argparse
-import re
+import hashlib
 import threading
 
-from pathlib import Path
-from typing import Generator, TYPE_CHECKING
+from concurrent.futures import ThreadPoolExecutor
+from typing import Generator, TYPE_CHECKING, Optional
 
-from sgsdb.parsing.model import ParsingResult
-from sgsdb.parsing.parallel import enqueue_thread, CloseableQueue, Closed
+import multiprocess
+
+from sgsdb.duplicates import ContentClaims
+from sgsdb.parsing.model import ParsingResult, ContentLoader
+from sgsdb.parsing.parallel import enqueue_thread, in_context, CloseableQueue, Closed, chunked
 from sgsdb.parsing.parser import RuleParser
 from sgsdb.parsing.statistic import ResultStatus
-from sgsdb.util import logger
+from sgsdb.parsing.validation import BatchValidator
+from sgsdb.rule import Rule
+from sgsdb.timing import measure, reset as reset_timing, get_timer
+from sgsdb.util import logger, build_logger
 
 if TYPE_CHECKING:
+    from multiprocess.context import BaseContext
+    from multiprocess.pool import AsyncResult, Pool
+
     from sgsdb.repository import Repository
 
-RE_FILENAME = re.compile(r'^.*\.ya?ml$')
-RE_TESTFILE = re.compile(r'^.*\.test\.ya?ml$')
+# Number of files shipped to a worker process at once when using the process executor
+PROCESS_BATCH_SIZE = 16
+# Number of rules validated by a single semgrep invocation with --verify
+VERIFY_BATCH_SIZE = 32
+
+# Processor of the current worker process, set up by the pool initializer
+_worker_processor: Optional['RuleProcessor'] = None
+
+
+def _pool_context() -> 'BaseContext':
+    """
+    Workers are started by a fork server instead of forking the build, whose download, pipeline and verify threads may
+    hold locks (e.g. of logging or queues) at the time of the fork. Platforms without a fork server spawn them.
+    """
+    if 'forkserver' not in multiprocess.get_all_start_methods():
+        return multiprocess.get_context('spawn')
+    context = multiprocess.get_context('forkserver')
+    context.set_forkserver_preload([__name__])
+    return context
+
+
+def _init_worker(args: argparse.Namespace, repo: 'Repository', known: Optional[dict[str, str]],
+                 unchanged: Optional[set[str]], claims: Optional[ContentClaims]) -> None:
+    global _worker_processor
+    # Workers start from a fresh interpreter, which knows nothing about the logging setup of the build
+    build_logger(args)
+    _worker_processor = RuleProcessor(args, repo, known, unchanged=unchanged, claims=claims)
+    if args.stats_json:
+        reset_timing()
+
+
+def _process_batch(batch: list[tuple[str, ContentLoader]]) -> tuple[list[tuple[str, Optional[str],
+                                                                              list[ResultStatus], list[dict]]],
+                                                                   list[tuple]]:
+    """
+    Reads and processes a batch of files inside a worker process and returns picklable payloads for each result,
+    together with the timings collected while processing the batch
+    """
+    payloads = []
+    for path, load in batch:
+        result = _worker_processor.handle(path, load)
+        payloads.append((result.path, result.digest, result.status, [rule.asdict() for rule in result.rules]))
+    timer = get_timer()
+    return payloads, [] if timer is None else timer.drain()
 
 
 class RuleProcessor:
-    def __init__(self, args: argparse.Namespace, repo: 'Repository') -> None:
+    def __init__(self, args: argparse.Namespace, repo: 'Repository', known: Optional[dict[str, str]] = None,
+                 budget: Optional[threading.Semaphore] = None, unchanged: Optional[set[str]] = None,
+                 claims: Optional[ContentClaims] = None) -> None:
         self.args = args
         self.repo = repo
+        # Content hashes of files that are already present in the database and do not need to be parsed again
+        self.known = known or {}
+        # Files the origin reported as unchanged since the last build, these are not even read
+        self.unchanged = unchanged or set()
+        # Content hashes of files read by any repository, files already read by a preceding repository are skipped
+        self.claims = claims
+        # Limits the number of files being processed at once, may be shared between the processors of all repositories
+        self.budget = budget or threading.BoundedSemaphore(args.threads)
         self.progress_mutex = threading.Lock()
         self.progress = None
         self.parser = RuleParser(args, repo)
 
-    def _process(self, in_queue: CloseableQueue[tuple[str, str]], out_queue: CloseableQueue[ParsingResult]) -> None:
-        while True:
-            try:
-                path, content = in_queue.get()
-                result = ParsingResult(self.repo, path, content)
-
-                if not self.filter_filename(result.path):
-                    result.status = [ResultStatus.IGNORED]
-                else:
-                    self.parser.process(result)
-
-                out_queue.put(result)
-            except Closed:
-                break
+    def handle(self, path: str, load: ContentLoader) -> ParsingResult:
+        digest = self.known.get(path) if path in self.unchanged else None
+        if digest is not None:
+            self._claim(digest)
+            return ParsingResult(self.repo, path, None, status=[ResultStatus.UNCHANGED], digest=digest)
+        with measure('read', self.repo.id):
+            content = load()
+        return self.process(path, content)
 
-    def filter_filename(self, filename: str) -> bool:
-        if not RE_FILENAME.match(filename) or RE_TESTFILE.match(filename):
-            if self.args.verbose > 1:
-                logger.debug('Ignoring due to file name: %s', filename)
-            return False
+    def process(self, path: str, content: bytes) -> ParsingResult:
+        result = ParsingResult(self.repo, path, content)
+        result.digest = hashlib.sha256(content).hexdigest()
+        if self.known.get(result.path) == result.digest:
+            self._claim(result.digest)
+            result.status = [ResultStatus.UNCHANGED]
+            result.release()
+            return result
+        if not self._claim(result.digest):
+            result.status = [ResultStatus.DUPLICATE]
+            result.release()
+            return result
 
-        path = Path(filename).relative_to(Path(filename).parents[-2])
-        if any(d.startswith('.') for d in path.parts):
-            if self.args.verbose > 1:
-                logger.debug('Ignoring hidden file: %s', path)
-            return False
+        self.parser.process(result)
+        return result
 
-        return True
+    def _claim(self, digest: str) -> bool:
+        return self.claims is None or self.claims.claim(digest, self.repo.id)
 
-    def _run(self, iterator: Generator[tuple[str, str], None, None],
-             result_queue: CloseableQueue[ParsingResult]) -> None:
+    def _process(self, in_queue: CloseableQueue[tuple[int, tuple[str, ContentLoader]]],
+                 out_queue: CloseableQueue[ParsingResult]) -> None:
+        while True:
+            try:
+                with measure('queue_wait', self.repo.id):
+                    index, (path, load) = in_queue.get()
+                with self.budget:
+                    result = self.handle(path, load)
+                result.index = index
+                with measure('result_put', self.repo.id):
+                    out_queue.put(result)
+            except Closed:
+                break
 
-        in_queue = CloseableQueue[tuple[str, str]]()
-        enqueue_thread(iterator, in_queue)
+    def _run_threads(self, iterator: Generator[tuple[str, ContentLoader], None, None],
+                     result_queue: CloseableQueue[ParsingResult]) -> None:
+        # Bounded, so the enqueue thread cannot run ahead of the workers. Files are only read by the worker.
+        in_queue = CloseableQueue[tuple[int, tuple[str, ContentLoader]]](self.args.queue_size)
+        enqueue = enqueue_thread(enumerate(iterator), in_queue)
 
-        threads = [threading.Thread(target=self._process, args=(in_queue, result_queue)) for _ in
-                   range(self.args.threads)]
+        threads = [threading.Thread(name=f'{self.repo.id}-worker-{i}', target=in_context(self._process),
+                                    args=(in_queue, result_queue)) for i in range(self.args.threads)]
         for thread in threads:
             thread.daemon = True
             thread.start()
 
         for thread in threads:
             thread.join()
+        # Unblocks the enqueue thread if the workers stopped because the results are not consumed anymore
+        in_queue.close()
+        enqueue.join()
+
+    def _run_processes(self, iterator: Generator[tuple[str, ContentLoader], None, None],
+                       result_queue: CloseableQueue[ParsingResult]) -> None:
+        # Every batch takes from the budget while a worker processes it. The budget is returned as soon as the batch is
+        # done, even if the result queue is full, so a repository waiting for its turn in the pipeline cannot hold the
+        # budget of the repository being emitted. Finished batches waiting to be handed out are bounded separately.
+        # Only the loaders are sent to the workers, which read the files themselves.
+        dispatched: CloseableQueue['AsyncResult'] = CloseableQueue(2 * self.args.threads)
+        errors = []
+
+        def release(_: object) -> None:
+            self.budget.release()
+
+        def dispatch(pool: 'Pool') -> None:
+            try:
+                for batch in chunked(iterator, PROCESS_BATCH_SIZE):
+                    if dispatched.closed():
+                        return
+                    self.budget.acquire()
+                    result = pool.apply_async(_process_batch, (batch,), callback=release, error_callback=release)
+                    try:
+                        dispatched.put(result)
+                    except Closed:
+                        # The results are not consumed anymore, the batch still has to return its budget
+                        result.wait()
+                        return
+            except Exception as e:
+                errors.append(e)
+            finally:
+                dispatched.close()
+
+        index = 0
+        with _pool_context().Pool(self.args.threads, initializer=_init_worker,
+                                  initargs=(self.args, self.repo, self.known, self.unchanged, self.claims)) as pool:
+            dispatcher = threading.Thread(name=f'{self.repo.id}-dispatch', target=in_context(dispatch), args=(pool,))
+            dispatcher.daemon = True
+            dispatcher.start()
+            timer = get_timer()
+            try:
+                while True:
+                    # Batches are handed out in submission order, so results are streamed back in archive order
+                    with measure('queue_wait', self.repo.id):
+                        try:
+                            payloads, timings = dispatched.get().get()
+                        except Closed:
+                            break
+                    if timer is not None:
+                        timer.merge(timings)
+                    for path, digest, status, rules in payloads:
+                        # Workers only know the claims made before the pool was started
+                        if digest is not None:
+                            self._claim(digest)
+                        result_queue.put(ParsingResult(self.repo, path, None, status=status, digest=digest,
+                                                       rules=[Rule.from_dict(rule) for rule in rules], index=index))
+                        index += 1
+            finally:
+                # If the results are not consumed anymore, wait for the batches in flight before the pool is
+                # terminated, otherwise they never return their budget
+                dispatched.close()
+                dispatcher.join()
+                while True:
+                    try:
+                        dispatched.get().wait()
+                    except Closed:
+                        break
+
+        if errors:
+            raise errors[0]
+
+    def _verify_batch(self, validator: BatchValidator, results: list[ParsingResult],
+                      out_queue: CloseableQueue[ParsingResult]) -> None:
+        rules = [(result.path, rule) for result in results for rule in result.rules]
+        try:
+            with self.budget, measure('verify', self.repo.id):
+                verdicts = iter(validator.validate(rules))
+        except Exception as e:
+            logger.debug(str(e), exc_info=e)
+            verdicts = None
+
+        for result in results:
+            rules, result.rules = result.rules, []
+            for rule in rules:
+                if verdicts is None:
+                    result.status.append(ResultStatus.EXCEPTION)
+                elif next(verdicts):
+                    result.rules.append(rule)
+                    result.status.append(ResultStatus.SUCCESS)
+                else:
+                    result.status.append(ResultStatus.INVALID_RULE)
+            out_queue.put(result)
+
+    def _verify(self, in_queue: CloseableQueue[ParsingResult], out_queue: CloseableQueue[ParsingResult]) -> None:
+        validator = BatchValidator(self.args)
+        # Bounds the number of parsed results waiting for verification
+        slots = threading.BoundedSemaphore(2 * self.args.threads)
+
+        def run(results: list[ParsingResult]) -> None:
+            try:
+                self._verify_batch(validator, results, out_queue)
+            finally:
+                slots.release()
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.args.threads, thread_name_prefix='verify') as executor:
+                batch = []
+                count = 0
+                # Stops verifying once the results are not consumed anymore
+                while not out_queue.closed():
+                    try:
+                        result = in_queue.get()
+                    except Closed:
+                        break
+                    if not result.rules:
+                        out_queue.put(result)
+                        continue
+
+                    batch.append(result)
+                    count += len(result.rules)
+                    if count >= VERIFY_BATCH_SIZE:
+                        slots.acquire()
+                        executor.submit(in_context(run), batch)
+                        batch = []
+                        count = 0
+
+                if batch and not out_queue.closed():
+                    slots.acquire()
+                    executor.submit(in_context(run), batch)
+        except Closed:
+            # The results are not consumed anymore
+            pass
+        finally:
+            # Unblocks the workers if they are waiting for room in the queue
+            in_queue.close()
+            validator.close()
+
+    def _run(self, iterator: Generator[tuple[str, ContentLoader], None, None],
+             result_queue: CloseableQueue[ParsingResult]) -> None:
+        # With --verify, parsed rules pass through a verification stage before they are handed out
+        parsed_queue = result_queue
+        verifier = None
+        if self.args.verify:
+            parsed_queue = CloseableQueue[ParsingResult](self.args.queue_size)
+            verifier = threading.Thread(target=in_context(self._verify), args=(parsed_queue, result_queue))
+            verifier.daemon = True
+            verifier.start()
 
-        # All input threads are done, we can safely close the result queue
-        result_queue.close()
+        try:
+            if self.args.executor == 'process':
+                self._run_processes(iterator, parsed_queue)
+            else:
+                self._run_threads(iterator, parsed_queue)
+        except Closed:
+            # The consumer stopped early
+            pass
+        finally:
+            if verifier is not None:
+                parsed_queue.close()
+                verifier.join()
+            # All workers are done, we can safely close the result queue
+            result_queue.close()
+            self.parser.close()
 
-    def start(self, iterator: Generator[tuple[str, str], None, None],
+    def start(self, iterator: Generator[tuple[str, ContentLoader], None, None],
               result_queue: CloseableQueue[ParsingResult]) -> threading.Thread:
-        thread = threading.Thread(target=self._run, args=(iterator, result_queue))
+        thread = threading.Thread(name=f'{self.repo.id}-processor', target=in_context(self._run),
+                                  args=(iterator, result_queue))
         thread.daemon = True
         thread.start()
         return thread
@@ -27,6 +27,8 @@ class ResultStatus(enum.Enum):
     EXCEPTION = 2
     MISSING_RULE = 3
     INVALID_RULE = 4
+    UNCHANGED = 5
+    DUPLICATE = 6
 
 
 @dataclass
@@ -36,6 +38,8 @@ class ParserStats:
     exceptions: int = 0
     missing_rules: int = 0
     invalid: int = 0
+    unchanged: int = 0
+    duplicates: int = 0
 
     def update(self, status: ResultStatus) -> None:
         if status == ResultStatus.SUCCESS:
@@ -48,6 +52,10 @@ class ParserStats:
             self.missing_rules += 1
         elif status == ResultStatus.INVALID_RULE:
             self.invalid += 1
+        elif status == ResultStatus.UNCHANGED:
+            self.unchanged += 1
+        elif status == ResultStatus.DUPLICATE:
+            self.duplicates += 1
         else:
             raise ValueError(f'Invalid result status: {status}')
 
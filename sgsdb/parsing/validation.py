@@ -27,10 +27,15 @@
 #      You should have received a copy of the GNU General Public License
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import argparse
+import bisect
+import functools
+import json
 import subprocess
 import tempfile
-from typing import Type, Any, Tuple, List
+from typing import Type, Any, Tuple, List, Optional
 
+from sgsdb.cache import VerificationCache
 from sgsdb.parsing.model import RuleMode
 from sgsdb.rule import Rule
 from sgsdb.util import logger
@@ -97,17 +102,149 @@ def is_valid(rule: dict) -> bool:
     return True
 
 
-def validate_rule_file(path: str, rule: Rule) -> bool:
+@functools.cache
+def semgrep_version() -> Optional[str]:
+    try:
+        proc = subprocess.run([  # noqa: S607, S603
+            'semgrep', '--disable-version-check', '--version'], shell=False, capture_output=True)
+    except OSError as e:
+        logger.debug('Unable to determine the semgrep version: %s', str(e))
+        return None
+    if proc.returncode != 0:
+        return None
+    return proc.stdout.decode('utf8', errors='replace').strip()
+
+
+def _run_semgrep(content: str, *args: str) -> subprocess.CompletedProcess:
     with tempfile.NamedTemporaryFile(delete=True, delete_on_close=False) as fp:
-        fp.write(rule.full_content.encode('utf8'))
+        fp.write(content.encode('utf8'))
         fp.close()
 
-        proc = subprocess.run([  # noqa: S607, S603
-            'semgrep', '--disable-version-check', '--metrics=off', '--validate', '--config', fp.name], shell=False,
-            capture_output=True)
+        return subprocess.run([  # noqa: S607, S603
+            'semgrep', '--disable-version-check', '--metrics=off', '--validate', *args, '--config', fp.name],
+            shell=False, capture_output=True)
 
-        if proc.returncode != 0:
-            logger.debug(path)
-            logger.debug(proc.stderr)
-            return False
-    return True
+
+def run_validation(content: str) -> Tuple[bool, str]:
+    proc = _run_semgrep(content)
+    return proc.returncode == 0, proc.stderr.decode('utf8', errors='replace')
+
+
+def run_batch_validation(content: str) -> Tuple[bool, Optional[List[dict]]]:
+    """
+    Validates a config containing multiple rules and returns the errors reported by semgrep (None if the output
+    could not be parsed)
+    """
+    proc = _run_semgrep(content, '--json')
+    if proc.returncode == 0:
+        return True, []
+    try:
+        return False, json.loads(proc.stdout).get('errors', [])
+    except (ValueError, AttributeError):
+        return False, None
+
+
+class BatchValidator:
+    """
+    Validates rules with semgrep, putting many rules into a single config to save on semgrep process starts
+    """
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.cache = VerificationCache() if args.verify_cache else None
+
+    def close(self) -> None:
+        if self.cache is not None:
+            self.cache.close()
+
+    @staticmethod
+    def _blame(errors: List[dict], batch: List[Tuple[int, str, str]], lines: List[int]) -> Optional[set[int]]:
+        """
+        Maps the errors reported for a batch to the rules that caused them, returns None if any error is ambiguous
+        """
+        blamed = set()
+        for error in errors:
+            rule_id = error.get('rule_id')
+            matches = [index for index, (_, id_, _) in enumerate(batch)
+                       if rule_id is not None and (rule_id == id_ or rule_id.endswith(f'.{id_}'))]
+            if len(matches) != 1:
+                spans = error.get('spans') or []
+                starts = [span.get('start', {}).get('line') for span in spans]
+                matches = list({bisect.bisect_right(lines, line) - 1 for line in starts if isinstance(line, int)})
+            if len(matches) != 1 or matches[0] < 0:
+                return None
+            blamed.add(matches[0])
+        return blamed
+
+    def _validate(self, batch: List[Tuple[int, str, str]]) -> dict[int, Tuple[bool, str]]:
+        if len(batch) == 1:
+            index, _, content = batch[0]
+            return {index: run_validation(content)}
+
+        # Concatenate the rules of all configs, keeping track of the line each rule starts at
+        body = ['rules:\n']
+        lines = []
+        line = 2
+        for _, _, content in batch:
+            rules = content.partition('\n')[2]
+            lines.append(line)
+            line += rules.count('\n')
+            body.append(rules)
+
+        valid, errors = run_batch_validation(''.join(body))
+        if valid:
+            return {index: (True, '') for index, _, _ in batch}
+
+        blamed = None if not errors else self._blame(errors, batch, lines)
+        if blamed is None:
+            # Semgrep did not tell which rules are broken, split the batch until it does
+            middle = len(batch) // 2
+            return {**self._validate(batch[:middle]), **self._validate(batch[middle:])}
+
+        # The blamed rules are checked on their own for the exact error, the remaining rules have to pass together
+        verdicts = {}
+        for position in blamed:
+            verdicts.update(self._validate([batch[position]]))
+        remaining = [entry for position, entry in enumerate(batch) if position not in blamed]
+        if remaining:
+            verdicts.update(self._validate(remaining))
+        return verdicts
+
+    def validate(self, rules: List[Tuple[str, Rule]]) -> List[bool]:
+        contents = [rule.full_content for _, rule in rules]
+
+        # Verdicts are only reusable for the exact semgrep version that produced them
+        version = semgrep_version() if self.cache is not None else None
+        keys = [None if version is None else VerificationCache.key(content, version) for content in contents]
+
+        verdicts: dict[int, Tuple[bool, str]] = {}
+        for index, key in enumerate(keys):
+            verdict = None if key is None else self.cache.get_verdict(key)
+            if verdict is not None:
+                verdicts[index] = verdict
+
+        # Rules sharing an ID cannot be validated within the same config
+        batches: List[List[Tuple[int, str, str]]] = []
+        for index, (_, rule) in enumerate(rules):
+            if index in verdicts:
+                continue
+            target = next((batch for batch in batches if all(id_ != rule.id for _, id_, _ in batch)), None)
+            if target is None:
+                target = []
+                batches.append(target)
+            target.append((index, rule.id, contents[index]))
+
+        for batch in batches:
+            for index, verdict in self._validate(batch).items():
+                verdicts[index] = verdict
+                if keys[index] is not None:
+                    self.cache.put_verdict(keys[index], *verdict)
+
+        result = []
+        for index, (path, _) in enumerate(rules):
+            valid, stderr = verdicts[index]
+            if not valid:
+                logger.debug(path)
+                logger.debug(stderr)
+            result.append(valid)
+        return result
@@ -0,0 +1,121 @@
+#      Semgrep-Search Database
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import closing
+from typing import Generator, Optional
+
+from sgsdb.duplicates import ContentClaims
+from sgsdb.manifest import Manifest
+from sgsdb.parsing.model import ParsingResult
+from sgsdb.parsing.parallel import CloseableQueue, Closed, in_context
+from sgsdb.profiling import checkpoint
+from sgsdb.repository import Repository
+from sgsdb.timing import measure
+
+
+class Pipeline:
+    """
+    Builds multiple repositories at once: archives are downloaded concurrently and the files of up to
+    args.pipeline_depth repositories are parsed concurrently, sharing a budget of args.threads workers. Results are
+    still emitted repository by repository in configuration order.
+    """
+
+    def __init__(self, args: argparse.Namespace, repositories: list[Repository],
+                 manifest: Optional[Manifest] = None) -> None:
+        self.args = args
+        self.repositories = repositories
+        self.manifest = manifest
+        # The repositories may have been fetched by a previous build with the same configuration
+        for repo in repositories:
+            repo.reset()
+        self.budget = threading.BoundedSemaphore(args.threads)
+        # Files with the same content yield the same IDs, which are all dropped if IDs have to be unique
+        self.claims = None
+        if args.ignore_duplicates and args.duplicate_key == 'id':
+            self.claims = ContentClaims([repo.id for repo in repositories])
+
+    def _produce(self, repo: Repository, fetch: Future, queue: CloseableQueue[ParsingResult],
+                 errors: list[Exception]) -> None:
+        try:
+            fetch.result()
+            known = unchanged = None
+            if self.manifest is not None:
+                known = self.manifest.files(repo.id)
+                changed = repo.changed_since(self.args, self.manifest.revision(repo.id))
+                if changed is not None:
+                    unchanged = known.keys() - changed
+            with closing(repo.iter_results(self.args, known, self.budget, unchanged, self.claims)) as results:
+                for result in results:
+                    queue.put(result)
+        except Closed:
+            # The pipeline stopped early, the results of this repository are not needed anymore
+            pass
+        except Exception as e:
+            errors.append(e)
+        finally:
+            queue.close()
+
+    def __iter__(self) -> Generator[ParsingResult, None, None]:
+        with ThreadPoolExecutor(max_workers=self.args.threads, thread_name_prefix='download') as downloads:
+            fetches = iter([(repo, downloads.submit(in_context(repo.fetch), self.args)) for repo in self.repositories])
+            stages = deque()
+
+            def start_next() -> None:
+                for repo, fetch in fetches:
+                    # Bounded, so repositories waiting for their turn do not buffer all of their results
+                    queue = CloseableQueue[ParsingResult](self.args.queue_size)
+                    errors = []
+                    thread = threading.Thread(name=f'pipeline-{repo.id}', target=in_context(self._produce),
+                                              args=(repo, fetch, queue, errors))
+                    thread.daemon = True
+                    thread.start()
+                    stages.append((repo, queue, thread, errors))
+                    return
+
+            try:
+                for _ in range(self.args.pipeline_depth):
+                    start_next()
+
+                while stages:
+                    repo, queue, thread, errors = stages[0]
+
+                    try:
+                        while True:
+                            with measure('pipeline_wait'):
+                                result = queue.get()
+                            yield result
+                    except Closed:
+                        pass
+
+                    thread.join()
+                    stages.popleft()
+                    if errors:
+                        raise errors[0]
+                    checkpoint(repo.id)
+
+                    start_next()
+            finally:
+                # The consumer stopped early or a repository failed: repositories that have not started are not
+                # fetched anymore and the ones being parsed stop once they try to hand out their next result
+                downloads.shutdown(wait=False, cancel_futures=True)
+                for _, queue, _, _ in stages:
+                    queue.close()
+                    queue.drain()
+                for _, _, thread, _ in stages:
+                    thread.join()
@@ -0,0 +1,157 @@
+#      Semgrep-Search Database
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+import cProfile
+import io
+import pstats
+import re
+import sys
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional, Generator
+
+from sgsdb.util import logger
+
+# Number of frames kept per allocation by tracemalloc, every additional frame makes tracing considerably slower
+TRACEMALLOC_FRAMES = 1
+
+# Active memory profiler, None unless enabled with --profile mem
+_memory: Optional['MemoryProfiler'] = None
+
+
+class CPUProfiler:
+    """
+    Profiles the main process including all threads it starts. Starting with Python 3.12 a single profiler covers all
+    threads, older versions need a profiler per thread, which is attached to every new thread.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.profiles: list[cProfile.Profile] = []
+
+    def _start_thread(self, *_: object) -> None:
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def start(self) -> None:
+        if sys.version_info < (3, 12):
+            threading.setprofile(self._start_thread)
+        self._start_thread()
+
+    def stop(self) -> pstats.Stats:
+        if sys.version_info < (3, 12):
+            threading.setprofile(None)
+        with self.lock:
+            profiles = list(self.profiles)
+        profiles[0].disable()
+
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        return stats
+
+    def write(self, prefix: str, top: int) -> None:
+        stats = self.stop()
+        stats.dump_stats(f'{prefix}.pstats')
+
+        summary = io.StringIO()
+        stats.stream = summary
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top)
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(top)
+        with Path(f'{prefix}.txt').open('w') as fout:
+            fout.write(summary.getvalue())
+        logger.info('Wrote CPU profile to %s.pstats and a summary to %s.txt', prefix, prefix)
+
+
+class MemoryProfiler:
+    """
+    Traces allocations and takes a snapshot at every stage boundary of the build
+    """
+
+    def __init__(self, prefix: str, top: int) -> None:
+        self.prefix = prefix
+        self.top = top
+        self.lock = threading.Lock()
+        self.snapshots: list[tuple[str, tracemalloc.Snapshot]] = []
+
+    def start(self) -> None:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        self.checkpoint('start')
+
+    def checkpoint(self, label: str) -> None:
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(inclusive=False, filename_pattern=tracemalloc.__file__),
+        ])
+        with self.lock:
+            index = len(self.snapshots)
+            self.snapshots.append((label, snapshot))
+        snapshot.dump(f'{self.prefix}-{index:02d}-{re.sub(r"[^A-Za-z0-9_.-]", "_", label)}.tracemalloc')
+
+    def write(self) -> None:
+        self.checkpoint('end')
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        lines = [f'Peak traced memory: {peak / 1024 / 1024:.1f} MiB', '']
+        previous = None
+        for label, snapshot in self.snapshots:
+            if previous is not None:
+                lines.append(f'Top {self.top} allocation changes since the previous stage at {label}:')
+                lines.extend(f'  {stat}' for stat in snapshot.compare_to(previous, 'lineno')[:self.top])
+                lines.append('')
+            previous = snapshot
+        with Path(f'{self.prefix}-mem.txt').open('w') as fout:
+            fout.write('\n'.join(lines))
+        logger.info('Wrote %d memory snapshots with prefix %s and a summary to %s-mem.txt', len(self.snapshots),
+                    self.prefix, self.prefix)
+
+
+def checkpoint(label: str) -> None:
+    """
+    Marks a stage boundary, a memory snapshot is taken if the memory profiler is active
+    """
+    if _memory is not None:
+        _memory.checkpoint(label)
+
+
+@contextmanager
+def profile(args: argparse.Namespace) -> Generator[None, None, None]:
+    global _memory
+    prefix = f'{args.DATABASE}.profile'
+
+    if args.profile == 'cpu':
+        if args.executor == 'process':
+            logger.warning('The CPU profile does not include the work done by worker processes')
+        profiler = CPUProfiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.write(prefix, args.profile_top)
+    elif args.profile == 'mem':
+        _memory = MemoryProfiler(prefix, args.profile_top)
+        _memory.start()
+        try:
+            yield
+        finally:
+            _memory.write()
+            _memory = None
+    else:
+        yield
@@ -14,22 +14,29 @@
 #      You should have received a copy of the GNU General Public License
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import argparse
-from dataclasses import dataclass
+import os
+import re
+import subprocess
+from dataclasses import dataclass, field, asdict
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import Generator, Tuple, Callable
-from zipfile import ZipFile
+from threading import Semaphore
+from typing import Generator, Tuple, Callable, Optional
 
-import requests
 from tqdm import tqdm
 from tqdm.contrib.logging import logging_redirect_tqdm
 
+from sgsdb.archive import MappedArchive
 from sgsdb.base_repo import BaseRepository
-from sgsdb.parsing.model import ParsingResult
+from sgsdb.download import download
+from sgsdb.duplicates import ContentClaims
+from sgsdb.parsing.matching import PathFilter
+from sgsdb.parsing.model import ParsingResult, ContentLoader
 from sgsdb.parsing.parallel import CloseableQueue, Closed
 from sgsdb.parsing.processing import RuleProcessor
 from sgsdb.parsing.statistic import ParserStats
 from sgsdb.rule import Rule
+from sgsdb.timing import measure, get_timer
 from sgsdb.util import logger, human_readable
 
 
@@ -42,18 +49,70 @@ class Repository(BaseRepository):
                 return GithubOrigin(id=id, **kwargs)
             case 'gitlab':
                 return GitlabOrigin(id=id, **kwargs)
+            case 'git':
+                return GitCloneOrigin(id=id, **kwargs)
+            case 'local':
+                return LocalOrigin(id=id, **kwargs)
+            case 'archive':
+                return ArchiveOrigin(id=id, **kwargs)
+
+    def fetch(self, args: argparse.Namespace) -> None:
+        """
+        Retrieves the repository data, origins that do not need to download anything do not override this
+        """
+
+    def reset(self) -> None:
+        """
+        Forgets the data fetched by a previous build, so the next build fetches the repository again
+        """
 
-    def get_paths(self, args: argparse.Namespace) -> Tuple[int, Callable[[], Generator[tuple[str, str], None, None]]]:
+    @property
+    def revision(self) -> Optional[str]:
+        """
+        Identifies the fetched state of the repository, None for origins that do not know about revisions
+        """
+        return None
+
+    def changed_since(self, args: argparse.Namespace, revision: Optional[str]) -> Optional[set[str]]:
+        """
+        Returns the paths of all files that changed since the given revision, None if this cannot be determined
+        """
+
+    def get_paths(self, args: argparse.Namespace) -> Tuple[int, int, Callable[[], Generator[tuple[str, ContentLoader],
+                                                                                            None, None]]]:
+        """
+        Returns the number of files to process, the number of ignored files and a factory for iterating over the paths
+        of the files to process. Every path comes with a loader that reads the content of the file when it is called.
+        """
         raise NotImplementedError
 
     def iter_rules(self, args: argparse.Namespace) -> Generator[Rule, None, None]:
+        for result in self.iter_results(args):
+            yield from result.rules
+
+    def reparse(self, args: argparse.Namespace, paths: set[str]) -> Generator[ParsingResult, None, None]:
+        """
+        Parses the given files again, regardless of whether they changed since the previous build
+        """
+        processor = RuleProcessor(args, self)
+        _, _, files_iter = self.get_paths(args)
+        for path, load in files_iter():
+            if path in paths:
+                with measure('read', self.id):
+                    content = load()
+                yield processor.process(path, content)
+
+    def iter_results(self, args: argparse.Namespace, known: Optional[dict[str, str]] = None,
+                     budget: Optional[Semaphore] = None,
+                     unchanged: Optional[set[str]] = None,
+                     claims: Optional[ContentClaims] = None) -> Generator[ParsingResult, None, None]:
         start_time = datetime.now(timezone.utc)
 
-        files_count, files_iter = self.get_paths(args)
+        files_count, ignored_count, files_iter = self.get_paths(args)
 
-        stats = ParserStats()
-        rules = CloseableQueue[ParsingResult]()
-        processor = RuleProcessor(args, self)
+        stats = ParserStats(ignored=ignored_count)
+        rules = CloseableQueue[ParsingResult](args.queue_size)
+        processor = RuleProcessor(args, self, known, budget, unchanged, claims)
 
         thread = processor.start(files_iter(), rules)
 
@@ -61,33 +120,67 @@ class Repository(BaseRepository):
         if args.progress:
             progress = tqdm(total=files_count, desc=f'Processing {self.name}')
 
+        # Workers finish files out of order, results are held back until all preceding files are done
+        pending: dict[int, ParsingResult] = {}
+        next_index = 0
+
         with logging_redirect_tqdm([logger]):
             try:
                 while True:
-                    result = rules.get()
-                    stats.register(result)
-                    yield from result.rules
-                    if progress:
-                        progress.update(1)
+                    with measure('result_wait', self.id):
+                        result = rules.get()
+                    pending[result.index] = result
+                    while next_index in pending:
+                        result = pending.pop(next_index)
+                        next_index += 1
+                        stats.register(result)
+                        yield result
+                        if progress:
+                            progress.update(1)
             except Closed:
                 pass
+            finally:
+                # Stops the processor if the results are not consumed anymore
+                rules.close()
+                # Wait for the processing thread to conclude
+                thread.join()
 
-        # Wait for the processing thread to conclude
-        thread.join()
+        if pending:
+            raise RuntimeError(f'Processing of {len(pending)} files of {self.name} did not complete')
 
         if progress:
             progress.close()
 
+        timer = get_timer()
+        if timer is not None:
+            timer.set_counts(self.id, asdict(stats))
+
         elapsed_time = datetime.now(timezone.utc) - start_time
-        logger.info('Finished loading %s in %s [Ignored: %d, Errors: %d, Successful: %d]', self.name,
-                    human_readable(elapsed_time), stats.ignored, stats.exceptions + stats.missing_rules + stats.invalid,
-                    stats.success)
+        logger.info('Finished loading %s in %s [Ignored: %d, Unchanged: %d, Duplicate: %d, Errors: %d, Successful: %d]',
+                    self.name, human_readable(elapsed_time), stats.ignored, stats.unchanged, stats.duplicates,
+                    stats.exceptions + stats.missing_rules + stats.invalid, stats.success)
+
+
+def archive_paths(args: argparse.Namespace, archive: MappedArchive) -> Tuple[int, int, Callable[
+        [], Generator[tuple[str, ContentLoader], None, None]]]:
+    path_filter = PathFilter(args)
+
+    # Only files that may contain rules are handed to the workers
+    members = list(filter(lambda member: path_filter(member.name), archive.members))
+
+    def _iter() -> Generator[tuple[str, ContentLoader], None, None]:
+        # Members are decompressed by whichever worker picks them up
+        for member in members:
+            yield member.name, archive.loader(member)
+
+    return len(members), len(archive.members) - len(members), _iter
 
 
 @dataclass
 class GitOrigin(Repository):
     repo: str
     branch: str
+    _fetched: bool = field(default=False, init=False, repr=False, compare=False)
 
     def to_dict(self) -> dict:
         return {**super().to_dict(), 'repo': self.repo, 'branch': self.branch}
@@ -95,29 +188,26 @@ class GitOrigin(Repository):
     def get_download_url(self) -> str:
         raise NotImplementedError
 
-    def _download_zip(self, args: argparse.Namespace) -> ZipFile:
-        filename = Path(f'cache/{self.id}.zip')
-        filename.parent.mkdir(exist_ok=True, parents=True)
-
-        if not args.cache or not filename.exists():
-            r = requests.get(self.get_download_url(), timeout=30)
-            r.raise_for_status()
-            with filename.open('wb+') as f:
-                f.write(r.content)
-
-        return ZipFile(filename)
+    @property
+    def archive_path(self) -> Path:
+        return Path(f'cache/{self.id}.zip')
 
-    def get_paths(self, args: argparse.Namespace) -> Tuple[int, Callable[[], Generator[tuple[str, str], None, None]]]:
-        archive = self._download_zip(args)
+    def fetch(self, args: argparse.Namespace) -> None:
+        if not self._fetched:
+            with measure('download', self.id):
+                download(args, self.get_download_url(), self.archive_path)
+            self._fetched = True
 
-        paths = list(filter(lambda file: not file.is_dir(), archive.filelist))
+    def reset(self) -> None:
+        self._fetched = False
 
-        def _iter() -> Generator[tuple[str, str], None, None]:
-            for file in paths:
-                with archive.open(file, 'r') as fin:
-                    yield file.filename, fin.read()
+    def _download_zip(self, args: argparse.Namespace) -> MappedArchive:
+        self.fetch(args)
+        return MappedArchive(self.archive_path)
 
-        return len(paths), _iter
+    def get_paths(self, args: argparse.Namespace) -> Tuple[int, int, Callable[[], Generator[tuple[str, ContentLoader],
+                                                                                            None, None]]]:
+        return archive_paths(args, self._download_zip(args))
 
 
 @dataclass
@@ -156,3 +246,204 @@ class GitlabOrigin(GitOrigin):
 
     def filepath(self, path: str) -> str:
         return f'{self.url}/-/blob/{self.branch}/{Path(path).relative_to(Path(path).parts[0])}'
+
+
+# Clone URLs of repositories on hosts whose file links can be derived from the URL
+RE_HOSTED_URL = re.compile(r'^(?:https?://(?:[^@/]+@)?|ssh://git@|git@)(?P<host>github\.com|gitlab\.com)[/:]'
+                           r'(?P<repo>.+?)(?:\.git)?/?$')
+
+
+def git(*args: str, cwd: Optional[Path] = None) -> str:
+    proc = subprocess.run(['git', *args], cwd=cwd, shell=False, capture_output=True, check=True,  # noqa: S607, S603
+                          env={**os.environ, 'GIT_TERMINAL_PROMPT': '0'})
+    return proc.stdout.decode('utf8')
+
+
+@dataclass
+class GitCloneOrigin(Repository):
+    """
+    Keeps a shallow clone of the branch in the cache, so only new objects have to be fetched on subsequent builds and
+    files that did not change since the last build do not have to be read at all
+    """
+    url: str
+    branch: str
+    # Same as DiskOrigin.web_url, only required for repositories that are not hosted on GitHub or GitLab
+    web_url: Optional[str] = None
+    _revision: Optional[str] = field(default=None, init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        if self.web_url is None and RE_HOSTED_URL.match(self.url) is None:
+            raise ValueError(f'Repository {self.id} requires a web_url, as links to its files cannot be derived from '
+                             f'{self.url}')
+
+    @property
+    def file_url(self) -> str:
+        """
+        Base URL for linking to files
+        """
+        if self.web_url is not None:
+            return self.web_url
+        match = RE_HOSTED_URL.match(self.url)
+        blob = 'blob' if match['host'] == 'github.com' else '-/blob'
+        return f'https://{match["host"]}/{match["repo"]}/{blob}/{self.branch}'
+
+    def to_dict(self) -> dict:
+        return {**super().to_dict(), 'type': 'Git', 'url': self.web_url or self.url, 'branch': self.branch}
+
+    @property
+    def clone_path(self) -> Path:
+        return Path(f'cache/{self.id}')
+
+    @property
+    def revision(self) -> Optional[str]:
+        return self._revision
+
+    def reset(self) -> None:
+        self._revision = None
+
+    def _update(self) -> None:
+        path = self.clone_path
+        if (path / '.git').is_dir():
+            git('remote', 'set-url', 'origin', self.url, cwd=path)
+            git('fetch', '--quiet', '--depth', '1', '--no-tags', 'origin', self.branch, cwd=path)
+            git('reset', '--quiet', '--hard', 'FETCH_HEAD', cwd=path)
+            git('clean', '--quiet', '-ffdx', cwd=path)
+        else:
+            path.parent.mkdir(exist_ok=True, parents=True)
+            git('clone', '--quiet', '--depth', '1', '--single-branch', '--no-tags', '--branch', self.branch, self.url,
+                str(path))
+
+    def fetch(self, args: argparse.Namespace) -> None:
+        if self._revision is not None:
+            return
+
+        cached = args.cache and (self.clone_path / '.git').is_dir()
+        try:
+            with measure('download', self.id):
+                self._update()
+        except subprocess.CalledProcessError as e:
+            message = e.stderr.decode('utf8', errors='replace').strip()
+            if not cached:
+                raise RuntimeError(f'Unable to fetch {self.url}: {message}') from e
+            logger.warning('Could not update %s, using the cached clone: %s', self.url, message)
+
+        self._revision = git('rev-parse', 'HEAD', cwd=self.clone_path).strip()
+
+    def _name(self, path: str) -> str:
+        # Paths are prefixed with a directory, just like the members of the archives of the other origins
+        return f'{self.id}/{path}'
+
+    def changed_since(self, args: argparse.Namespace, revision: Optional[str]) -> Optional[set[str]]:
+        self.fetch(args)
+        if revision is None:
+            return None
+        if revision == self._revision:
+            return set()
+
+        try:
+            changed = git('diff', '--name-only', '--no-renames', '-z', revision, self._revision, cwd=self.clone_path)
+        except subprocess.CalledProcessError:
+            # The previous revision is not part of the clone anymore
+            return None
+        return {self._name(path) for path in changed.split('\0') if path}
+
+    def get_paths(self, args: argparse.Namespace) -> Tuple[int, int, Callable[[], Generator[tuple[str, ContentLoader],
+                                                                                            None, None]]]:
+        self.fetch(args)
+        path_filter = PathFilter(args)
+
+        files = [path for path in git('ls-files', '-z', cwd=self.clone_path).split('\0') if path]
+        paths = [path for path in files if path_filter(self._name(path))]
+
+        def _iter() -> Generator[tuple[str, ContentLoader], None, None]:
+            for path in paths:
+                yield self._name(path), (self.clone_path / path).read_bytes
+
+        return len(paths), len(files) - len(paths), _iter
+
+    def __repr__(self) -> str:
+        return self.url
+
+    def filepath(self, path: str) -> str:
+        return f'{self.file_url}/{Path(path).relative_to(Path(path).parts[0])}'
+
+
+@dataclass
+class DiskOrigin(Repository):
+    """
+    Base of the origins reading rules from a path on disk, files link to the path unless a web URL is configured
+    """
+    path: str
+    # Base URL for linking to files, e.g. https://github.com/semgrep/semgrep-rules/blob/develop
+    web_url: Optional[str] = None
+
+    @property
+    def url(self) -> str:
+        return self.web_url or Path(self.path).resolve().as_uri()
+
+    def __repr__(self) -> str:
+        return self.url
+
+    def filepath(self, path: str) -> str:
+        return f'{self.url}/{Path(path).relative_to(Path(path).parts[0])}'
+
+
+@dataclass(repr=False)
+class LocalOrigin(DiskOrigin):
+    """
+    Reads the rules from a directory that has already been checked out, nothing has to be downloaded or extracted
+    """
+
+    def to_dict(self) -> dict:
+        return {**super().to_dict(), 'type': 'Local', 'url': self.url}
+
+    def _walk(self) -> Generator[tuple[str, str], None, None]:
+        """
+        Yields the name and the location of every file below the directory. Hidden directories (e.g. .git) cannot
+        contain rules and are not descended into.
+        """
+        directories = [(self.path, self.id)]
+        while directories:
+            directory, prefix = directories.pop()
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+            subdirectories = []
+            for entry in entries:
+                name = f'{prefix}/{entry.name}'
+                if entry.is_dir(follow_symlinks=False):
+                    if not entry.name.startswith('.'):
+                        subdirectories.append((entry.path, name))
+                elif entry.is_file():
+                    yield name, entry.path
+            directories.extend(reversed(subdirectories))
+
+    def get_paths(self, args: argparse.Namespace) -> Tuple[int, int, Callable[[], Generator[tuple[str, ContentLoader],
+                                                                                            None, None]]]:
+        path_filter = PathFilter(args)
+
+        files = 0
+        paths = []
+        for name, location in self._walk():
+            files += 1
+            if path_filter(name):
+                paths.append((name, location))
+
+        def _iter() -> Generator[tuple[str, ContentLoader], None, None]:
+            for name, location in paths:
+                yield name, Path(location).read_bytes
+
+        return len(paths), files - len(paths), _iter
+
+
+@dataclass(repr=False)
+class ArchiveOrigin(DiskOrigin):
+    """
+    Reads the rules from a zip archive on disk, e.g. an archive of a repository that was downloaded beforehand
+    """
+
+    def to_dict(self) -> dict:
+        return {**super().to_dict(), 'type': 'Archive', 'url': self.url}
+
+    def get_paths(self, args: argparse.Namespace) -> Tuple[int, int, Callable[[], Generator[tuple[str, ContentLoader],
+                                                                                            None, None]]]:
+        return archive_paths(args, MappedArchive(Path(self.path)))
@@ -18,10 +18,11 @@ from dataclasses import dataclass
 from io import StringIO
 from typing import Optional
 
-from ruamel.yaml import CommentedMap, CommentedSeq, YAML
+from ruamel.yaml import CommentedMap, YAML
 
 from .base_repo import BaseRepository
-from .util import fix_languages, remove_comments
+from .timing import measure
+from .util import fix_languages, remove_comments, get_yaml
 
 
 @dataclass
@@ -36,24 +37,33 @@ class Rule:
     content: str
 
     @staticmethod
-    def from_file(source: BaseRepository, data: dict, path: str) -> 'Rule':
-        # Remove all comments as their indentation might be broken
-        data = remove_comments(data)
+    def from_file(source: BaseRepository, data: dict, path: str, yaml: Optional[YAML] = None) -> 'Rule':
+        """
+        Creates a rule from its data as loaded from a rule file, data loaded by the safe loader is dumped using the
+        given (safe) yaml instance.
+        """
+        if isinstance(data, CommentedMap):
+            # Remove all comments as their indentation might be broken
+            with measure('remove_comments', source.id):
+                data = remove_comments(data)
+        # Keep the mapping type of the loader, the safe dumper does not support commented maps
+        mapping = type(data)
 
         # Add metadata
-        data.setdefault('metadata', CommentedMap())
-        data['metadata'].setdefault('semgrep.dev', CommentedMap())
-        data['metadata']['semgrep.dev'].setdefault('rule', CommentedMap())
+        data.setdefault('metadata', mapping())
+        data['metadata'].setdefault('semgrep.dev', mapping())
+        data['metadata']['semgrep.dev'].setdefault('rule', mapping())
         data['metadata']['semgrep.dev']['rule']['origin'] = source.name
 
-        data['metadata'].setdefault('semgrep-search', CommentedMap())
+        data['metadata'].setdefault('semgrep-search', mapping())
         data['metadata']['semgrep-search']['id'] = source.id
         data['metadata']['semgrep-search']['name'] = source.name
         data['metadata']['semgrep-search']['source'] = repr(source)
         data['metadata']['semgrep-search']['file'] = source.filepath(path)
 
         buf = StringIO()
-        YAML(typ='rt').dump(data, buf)
+        with measure('dump', source.id):
+            (yaml or get_yaml()).dump(data, buf)
 
         return Rule(
             source.id,
@@ -66,11 +76,28 @@ class Rule:
             buf.getvalue(),
         )
 
+    @staticmethod
+    def from_dict(data: dict) -> 'Rule':
+        """
+        Recreates a rule from the output of asdict, the rule data is loaded lazily from the content if required
+        """
+        return Rule(**data, _data=None)
+
     def asdict(self) -> dict:
         return {key: value for key, value in dataclasses.asdict(self).items() if not key.startswith('_')}
 
+    @property
+    def data(self) -> dict:
+        if self._data is None:
+            # The content has been dumped already, so it is plain YAML the safe loader reads a lot faster
+            self._data = get_yaml('fast').load(self.content)
+        return self._data
+
     @property
     def full_content(self) -> str:
-        buf = StringIO()
-        YAML(typ='rt').dump(CommentedMap({'rules': CommentedSeq([self._data])}), buf)
-        return buf.getvalue()
+        """
+        The rule as a standalone config, derived from the already dumped content by nesting it into the rules sequence
+        """
+        lines = self.content.splitlines(keepends=True)
+        nested = (f'  {line}' if line.rstrip('\n') else line for line in lines[1:])
+        return ''.join(['rules:\n', f'- {lines[0]}', *nested])
@@ -0,0 +1,182 @@
+#      Semgrep-Search Database
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import base64
+import hashlib
+import re
+import struct
+from collections import defaultdict
+from typing import Iterable, Optional
+
+from sgsdb.rule import Rule
+
+# Number of hash functions of a signature, split into bands of rows for locality sensitive hashing. Rules sharing all
+# rows of any band become candidates, which happens for ~50% similar rules and is then checked against the threshold.
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+# Number of preceding rules of the same bucket every rule is compared to, buckets of common patterns can be huge
+BUCKET_WINDOW = 32
+
+# Number of consecutive tokens forming a shingle
+SHINGLE_SIZE = 3
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+SIGNATURE = struct.Struct(f'<{NUM_PERM}I')
+
+# Keys that do not change what a rule matches
+IGNORED_KEYS = {'id', 'message', 'metadata', 'severity', 'languages', 'min-version', 'max-version'}
+
+RE_TOKEN = re.compile(r'\$\.\.\.[A-Z_][A-Z0-9_]*|\$[A-Z_][A-Z0-9_]*|\.\.\.|\w+|[^\w\s]')
+
+Signature = tuple[int, ...]
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode('utf8'), digest_size=8).digest(), 'little')
+
+
+# Signatures are stored in the manifest, so the hash functions have to be the same for every run
+PERMUTATIONS = [(_hash(f'a{i}') % (MERSENNE_PRIME - 1) + 1, _hash(f'b{i}') % MERSENNE_PRIME) for i in range(NUM_PERM)]
+
+
+def _normalize(token: str) -> str:
+    # Renaming a metavariable does not change what a rule matches
+    if token.startswith('$...'):
+        return '$...'
+    if token.startswith('$'):
+        return '$X'
+    return token
+
+
+def shingles(rule: Rule) -> set[str]:
+    """
+    Returns the shingles of the pattern tree of a rule: the path of every key (ignoring positions in sequences) and
+    runs of SHINGLE_SIZE normalized tokens of every value, prefixed with the path they occur at.
+    """
+    result = {f'languages:{language}' for language in rule.languages}
+    stack: list[tuple[str, object]] = [(key, value) for key, value in rule.data.items() if key not in IGNORED_KEYS]
+    while stack:
+        path, value = stack.pop()
+        if isinstance(value, dict):
+            result.add(path)
+            stack.extend((f'{path}/{key}', child) for key, child in value.items())
+        elif isinstance(value, list):
+            stack.extend((path, child) for child in value)
+        else:
+            tokens = [_normalize(token) for token in RE_TOKEN.findall(str(value))]
+            for i in range(max(len(tokens) - SHINGLE_SIZE, 0) + 1):
+                result.add(f'{path}:{" ".join(tokens[i:i + SHINGLE_SIZE])}')
+    return result
+
+
+def signature(rule: Rule) -> Optional[Signature]:
+    """
+    Computes the MinHash signature of the pattern tree of a rule, rules without any shingles have no signature
+    """
+    hashes = [_hash(shingle) for shingle in shingles(rule)]
+    if not hashes:
+        return None
+    return tuple(min((a * value + b) % MERSENNE_PRIME for value in hashes) & MAX_HASH for a, b in PERMUTATIONS)
+
+
+def encode(value: Signature) -> str:
+    return base64.b64encode(SIGNATURE.pack(*value)).decode('ascii')
+
+
+def decode(value: str) -> Signature:
+    return SIGNATURE.unpack(base64.b64decode(value))
+
+
+def similarity(a: Signature, b: Signature) -> float:
+    """
+    Estimates the Jaccard similarity of the shingles two signatures were computed from
+    """
+    return sum(x == y for x, y in zip(a, b, strict=True)) / NUM_PERM
+
+
+class NearDuplicateIndex:
+    """
+    Groups rules whose pattern trees are at least threshold similar into clusters, using locality sensitive hashing
+    over MinHash signatures, so the time spent is roughly linear in the number of rules. Rules are identified by their
+    repository, the file they stem from (as linked in their semgrep-search metadata) and their ID, as IDs are not
+    unique within a repository.
+    """
+
+    def __init__(self, threshold: float) -> None:
+        self.threshold = threshold
+        self.rules: list[tuple[str, str, str]] = []
+        self.signatures: list[Signature] = []
+
+    def add(self, source: str, file: str, rule_id: str, value: Signature) -> None:
+        self.rules.append((source, file, rule_id))
+        self.signatures.append(value)
+
+    def add_all(self, source: str, file: str, rule_ids: Iterable[str], values: Iterable[Optional[str]]) -> None:
+        """
+        Adds the rules of a file along with their encoded signatures, as stored in the manifest
+        """
+        for rule_id, value in zip(rule_ids, values, strict=True):
+            if value is not None:
+                self.add(source, file, rule_id, decode(value))
+
+    def clusters(self) -> list[dict]:
+        """
+        Returns all clusters with more than one rule, the rules are kept in the order they were added, so the first
+        one stems from the repository listed first in the configuration
+        """
+        parents = list(range(len(self.rules)))
+
+        def find(i: int) -> int:
+            while parents[i] != i:
+                parents[i] = parents[parents[i]]
+                i = parents[i]
+            return i
+
+        def union(i: int, j: int) -> None:
+            i, j = find(i), find(j)
+            if i != j:
+                parents[max(i, j)] = min(i, j)
+
+        # Rules with identical signatures are merged right away, which keeps the buckets of copied rules small
+        identical: dict[Signature, int] = {}
+        distinct = []
+        for i, value in enumerate(self.signatures):
+            first = identical.setdefault(value, i)
+            if first == i:
+                distinct.append(i)
+            else:
+                union(first, i)
+
+        buckets: dict[tuple[int, Signature], list[int]] = defaultdict(list)
+        for i in distinct:
+            value = self.signatures[i]
+            for band in range(BANDS):
+                buckets[band, value[band * ROWS:(band + 1) * ROWS]].append(i)
+
+        for members in buckets.values():
+            for n, i in enumerate(members):
+                for j in members[max(0, n - BUCKET_WINDOW):n]:
+                    if find(i) != find(j) and similarity(self.signatures[i], self.signatures[j]) >= self.threshold:
+                        union(i, j)
+
+        clusters: dict[int, list[int]] = defaultdict(list)
+        for i in range(len(self.rules)):
+            clusters[find(i)].append(i)
+        return [
+            {'rules': [{'source': self.rules[i][0], 'file': self.rules[i][1], 'id': self.rules[i][2]} for i in members]}
+            for members in clusters.values() if len(members) > 1
+        ]
@@ -0,0 +1,152 @@
+#      Semgrep-Search Database
+#      Copyright (C) 2024  Malte Heinzelmann
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import json
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Optional, Generator
+
+import multiprocess
+
+# Collects the timings of the current build, None unless enabled with --stats-json. Threads started by the build run
+# in a copy of its context (see parallel.in_context), so concurrent builds in the same process do not share a timer.
+_timer: ContextVar[Optional['StageTimer']] = ContextVar('timer', default=None)
+
+
+def worker_name() -> str:
+    process = multiprocess.current_process()
+    if process.name == 'MainProcess':
+        return threading.current_thread().name
+    return process.name
+
+
+class StageTimer:
+    """
+    Accumulates the time spent in the stages of a build per repository and per worker
+    """
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        # (repository, worker, stage) -> [seconds, count]
+        self.timings: dict[tuple[Optional[str], str, str], list[float | int]] = {}
+        self.counts: dict[str, dict[str, int]] = {}
+
+    def add(self, stage: str, seconds: float, repo: Optional[str] = None, count: int = 1,
+            worker: Optional[str] = None) -> None:
+        key = (repo, worker or worker_name(), stage)
+        with self.lock:
+            timing = self.timings.setdefault(key, [0.0, 0])
+            timing[0] += seconds
+            timing[1] += count
+
+    def merge(self, timings: list[tuple[Optional[str], str, str, float, int]]) -> None:
+        """
+        Adds the timings drained from the timer of a worker process
+        """
+        for repo, worker, stage, seconds, count in timings:
+            self.add(stage, seconds, repo, count, worker)
+
+    def drain(self) -> list[tuple[Optional[str], str, str, float, int]]:
+        with self.lock:
+            timings, self.timings = self.timings, {}
+        return [(*key, seconds, count) for key, (seconds, count) in timings.items()]
+
+    def set_counts(self, repo: str, counts: dict[str, int]) -> None:
+        with self.lock:
+            self.counts[repo] = counts
+
+    def report(self) -> dict:
+        def entry(timing: list[float | int]) -> dict:
+            return {'seconds': round(timing[0], 6), 'count': timing[1]}
+
+        def add_to(stages: dict[str, list[float | int]], stage: str, timing: list[float | int]) -> None:
+            total = stages.setdefault(stage, [0.0, 0])
+            total[0] += timing[0]
+            total[1] += timing[1]
+
+        with self.lock:
+            timings = dict(self.timings)
+            counts = dict(self.counts)
+
+        stages = {}
+        repositories = {}
+        for (repo, worker, stage), timing in sorted(timings.items(), key=lambda item: tuple(map(str, item[0]))):
+            add_to(stages, stage, timing)
+            if repo is None:
+                continue
+            repository = repositories.setdefault(repo, {'stages': {}, 'workers': {}})
+            add_to(repository['stages'], stage, timing)
+            add_to(repository['workers'].setdefault(worker, {}), stage, timing)
+
+        return {
+            'elapsed_seconds': round(time.perf_counter() - self.start, 6),
+            'stages': {stage: entry(timing) for stage, timing in stages.items()},
+            'repositories': {
+                repo: {
+                    'counts': counts.get(repo, {}),
+                    'stages': {stage: entry(timing) for stage, timing in repository['stages'].items()},
+                    'workers': {worker: {stage: entry(timing) for stage, timing in worker_stages.items()}
+                                for worker, worker_stages in repository['workers'].items()},
+                } for repo, repository in repositories.items()
+            },
+        }
+
+    def write(self, path: Path) -> None:
+        with path.open('w') as fout:
+            json.dump(self.report(), fout, indent=2)
+
+
+@contextmanager
+def collect(*, enabled: bool) -> Generator[Optional[StageTimer], None, None]:
+    """
+    Collects the timings of the stages run within the block in a new timer, if enabled
+    """
+    token = _timer.set(StageTimer() if enabled else None)
+    try:
+        yield _timer.get()
+    finally:
+        _timer.reset(token)
+
+
+def reset() -> StageTimer:
+    """
+    Replaces the timer with an empty one. Worker processes inherit the timer of the parent when they are forked, the
+    timings it collected would be reported twice and its lock might be held by a thread that does not exist anymore.
+    """
+    timer = StageTimer()
+    _timer.set(timer)
+    return timer
+
+
+def get_timer() -> Optional[StageTimer]:
+    return _timer.get()
+
+
+@contextmanager
+def measure(stage: str, repo: Optional[str] = None) -> Generator[None, None, None]:
+    timer = _timer.get()
+    if timer is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(stage, time.perf_counter() - start, repo)
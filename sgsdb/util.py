@@ -16,7 +16,7 @@
 import argparse
 import logging
 import sys
-from collections import OrderedDict
+import threading
 from datetime import timedelta, datetime, timezone
 from importlib import metadata
 from importlib.metadata import PackageNotFoundError
@@ -25,7 +25,9 @@ from typing import Tuple, Union, Any
 
 import tomli
 from gitinfo import gitinfo
-from ruamel.yaml import CommentedSeq, CommentedMap
+from ruamel.yaml import CommentedSeq, CommentedMap, YAML
+from ruamel.yaml.nodes import ScalarNode
+from ruamel.yaml.representer import SafeRepresenter
 
 from sgsdb.const import LANGUAGE_ALIASES
 
@@ -57,6 +59,48 @@ def human_readable(td: timedelta) -> str:
 
 logger = logging.getLogger('semgrep-search-db')
 
+_yaml_instances = threading.local()
+
+
+class FastRepresenter(SafeRepresenter):
+    """
+    Safe representer emitting multi-line strings as literal blocks, like the round-trip dumper does for block scalars
+    """
+
+    def represent_str(self, data: str) -> ScalarNode:
+        if '\n' in data:
+            return self.represent_scalar('tag:yaml.org,2002:str', data, style='|')
+        return super().represent_str(data)
+
+
+FastRepresenter.add_representer(str, FastRepresenter.represent_str)
+
+
+def _create_yaml(typ: str) -> YAML:
+    if typ != 'fast':
+        return YAML(typ=typ)
+
+    # The libyaml backed safe loader and emitter (if ruamel.yaml.clib is available), keeping the key order
+    yaml = YAML(typ='safe', pure=False)
+    yaml.Representer = FastRepresenter
+    yaml.default_flow_style = False
+    yaml.sort_base_mapping_type_on_output = False
+    yaml.allow_unicode = True
+    return yaml
+
+
+def get_yaml(typ: str = 'rt') -> YAML:
+    """
+    Returns a YAML instance owned by the current thread, constructing one is costly and instances are not thread safe.
+    Besides the ruamel types, 'fast' returns the libyaml backed safe instance.
+    """
+    instances = getattr(_yaml_instances, 'instances', None)
+    if instances is None:
+        instances = _yaml_instances.instances = {}
+    if typ not in instances:
+        instances[typ] = _create_yaml(typ)
+    return instances[typ]
+
 
 def build_logger(args: argparse.Namespace) -> None:
     log_format = '%(message)s'
@@ -73,33 +117,59 @@ def build_logger(args: argparse.Namespace) -> None:
     logger.setLevel(logging.DEBUG)
 
 
-def generate_metdata() -> dict:
-    git = gitinfo.get_git_info()
-
+def get_version() -> str:
     try:
-        version = metadata.version('semgrep-search-db')
+        return metadata.version('semgrep-search-db')
     except PackageNotFoundError:
         try:
             with Path('pyproject.toml').open('rb') as fin:
-                version = tomli.load(fin).get('tool').get('poetry').get('version')
+                return tomli.load(fin).get('tool').get('poetry').get('version')
         except Exception:
-            version = '0.0.0-dev'
+            return '0.0.0-dev'
+
+
+def generate_metdata() -> dict:
+    git = gitinfo.get_git_info()
 
     return {
         'created_on': str(datetime.now(timezone.utc)),
-        'version': version,
+        'version': get_version(),
         'commit': 'unknown' if git is None else git['commit'][:7],
         'min_version': '1.1.0',
     }
 
 
-def remove_comments(data: Any) -> Any:  # noqa: ANN401
-    if isinstance(data, (dict, OrderedDict, CommentedMap)):
-        return CommentedMap(OrderedDict([
-            (key, remove_comments(value)) for key, value in data.items()
-        ]))
+def _strip_copy(value: Any) -> Any:  # noqa: ANN401
+    if isinstance(value, dict):
+        return CommentedMap()
+    if isinstance(value, list):
+        return CommentedSeq()
+    return value
 
-    if isinstance(data, (list, CommentedSeq)):
-        return CommentedSeq([remove_comments(item) for item in data])
 
-    return data
+def remove_comments(data: Any) -> Any:  # noqa: ANN401
+    """
+    Returns a copy of data without the comments, anchors and styles of the round-trip loader. Containers are copied
+    in a single iterative pass, so deeply nested rules cannot exceed the recursion limit.
+    """
+    root = _strip_copy(data)
+    if root is data:
+        return data
+
+    # Every copied container is created empty right away, so keys keep their order, and filled once it is popped
+    pending = [(data, root)]
+    while pending:
+        source, target = pending.pop()
+        if isinstance(source, dict):
+            for key, value in dict.items(source):
+                copy = target[key] = _strip_copy(value)
+                if copy is not value:
+                    pending.append((value, copy))
+        else:
+            for value in source:
+                copy = _strip_copy(value)
+                target.append(copy)
+                if copy is not value:
+                    pending.append((value, copy))
+
+    return root